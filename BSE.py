@@ -49,6 +49,11 @@ import sys
 import math
 import random
 
+import quantiser
+import registry
+import sweep
+import validation
+
 
 bse_sys_minprice = 1  # minimum price in the system, in cents/pennies
 bse_sys_maxprice = 1000  # maximum price in the system, in cents/pennies
@@ -203,6 +208,11 @@ class Orderbook_half:
 
 
 
+# how the exchange puts quote prices on the tick grid: None takes prices as the traders quote them,
+# or a quantiser.PriceQuantiser that rounds them before they reach the book (see the sweep's price_quantiser)
+price_quantiser = None
+
+
 # Orderbook for a single instrument: list of bids and list of asks
 
 class Orderbook(Orderbook_half):
@@ -212,6 +222,7 @@ class Orderbook(Orderbook_half):
                 self.asks = Orderbook_half('Ask', bse_sys_maxprice)
                 self.tape = []
                 self.quote_id = 0  #unique ID code for each quote accepted onto the book
+                self.quantiser = price_quantiser
 
 
 
@@ -270,6 +281,12 @@ class Exchange(Orderbook):
 
 
 
+        # put an order's price on the quantiser's grid, before it is checked and sent to process_order2()
+        def quantise(self, order):
+                if self.quantiser != None:
+                        order.price = self.quantiser.quantise(order.price, order.otype)
+
+
         def process_order2(self, time, order, verbose):
                 # receive an order and either add it to the relevant LOB (ie treat as limit order)
                 # or if it crosses the best counterparty offer, execute it (treat as a market order)
@@ -372,6 +389,10 @@ class Exchange(Orderbook):
 ##################--Traders below here--#############
 
 
+# robot type -> trader class, filled in as the trader classes below are defined (see registry.py)
+trader_registry = registry.TraderRegistry()
+
+
 # Trader superclass
 # all Traders have a trader id, bank balance, blotter, and list of orders to execute
 class Trader:
@@ -432,12 +453,6 @@ class Trader:
                 self.n_trades += 1
                 self.profitpertime = self.balance/(time - self.birthtime)
 
-                if profit < 0 :
-                        print(profit)
-                        print(trade)
-                        print(order)
-                        sys.exit()
-
                 if verbose: print('%s profit=%d balance=%d profit/time=%d' % (outstr, profit, self.balance, self.profitpertime))
                 self.del_order(order)  # delete the order
 
@@ -473,6 +488,9 @@ class Trader_Giveaway(Trader):
                 return order
 
 
+trader_registry.register('GVWY', Trader_Giveaway)
+
+
 
 # Trader subclass ZI-C
 # After Gode & Sunder 1993
@@ -498,6 +516,9 @@ class Trader_ZIC(Trader):
                 return order
 
 
+trader_registry.register('ZIC', Trader_ZIC)
+
+
 # Trader subclass Shaver
 # shaves a penny off the best price
 # if there is no best price, creates "stub quote" at system max/min
@@ -528,6 +549,9 @@ class Trader_Shaver(Trader):
                 return order
 
 
+trader_registry.register('SHVR', Trader_Shaver)
+
+
 # Trader subclass Sniper
 # Based on Shaver,
 # "lurks" until time remaining < threshold% of the trading session
@@ -563,6 +587,9 @@ class Trader_Sniper(Trader):
                 return order
 
 
+trader_registry.register('SNPR', Trader_Sniper)
+
+
 
 
 # Trader subclass ZIP
@@ -782,6 +809,9 @@ class Trader_ZIP(Trader):
                 self.prev_best_ask_q = lob_best_ask_q
 
 
+trader_registry.register('ZIP', Trader_ZIP)
+
+
 
 
 ##########################---trader-types have all been defined now--################
@@ -839,18 +869,7 @@ def trade_stats(expid, traders, dumpfile, time, lob):
 def populate_market(traders_spec, traders, shuffle, verbose):
 
         def trader_type(robottype, name):
-                if robottype == 'GVWY':
-                        return Trader_Giveaway('GVWY', name, 0.00, 0)
-                elif robottype == 'ZIC':
-                        return Trader_ZIC('ZIC', name, 0.00, 0)
-                elif robottype == 'SHVR':
-                        return Trader_Shaver('SHVR', name, 0.00, 0)
-                elif robottype == 'SNPR':
-                        return Trader_Sniper('SNPR', name, 0.00, 0)
-                elif robottype == 'ZIP':
-                        return Trader_ZIP('ZIP', name, 0.00, 0)
-                else:
-                        sys.exit('FATAL: don\'t know robot type %s\n' % robottype)
+                return trader_registry.lookup(robottype)(robottype, name, 0.00, 0)
 
 
         def shuffle_traders(ttype_char, n, traders):
@@ -1106,12 +1125,19 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
 
 
 # one session in the market
-def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dumpfile, dump_each_trade, verbose):
+# quotes and trades are checked by validator (see validation.py), which collects the violations of every
+# session it is handed; without one, the session makes its own that checks everything
+def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dumpfile, dump_each_trade, verbose,
+                   validator=None):
 
 
         # initialise the exchange
         exchange = Exchange()
 
+        if validator == None:
+                validator = validation.Validator()
+        validator.start_session(sess_id)
+
 
         # create a bunch of traders
         traders = {}
@@ -1167,16 +1193,22 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
                 # if verbose: print('Trader Quote: %s' % (order))
 
                 if order != None:
-                        if order.otype == 'Ask' and order.price < traders[tid].orders[0].price: sys.exit('Bad ask')
-                        if order.otype == 'Bid' and order.price > traders[tid].orders[0].price: sys.exit('Bad bid')
+                        # the price is put on the exchange's grid first, so the check sees the price that reaches the book
+                        exchange.quantise(order)
+                        if not validator.check_quote(time, traders[tid], order):
+                                # the quote is reported and not sent to the exchange
+                                order = None
+
+                if order != None:
                         # send order to exchange
                         traders[tid].n_quotes = 1
                         trade = exchange.process_order2(time, order, process_verbose)
                         if trade != None:
                                 # trade occurred,
                                 # so the counterparties update order lists and blotters
-                                traders[trade['party1']].bookkeep(trade, order, bookkeep_verbose, time)
-                                traders[trade['party2']].bookkeep(trade, order, bookkeep_verbose, time)
+                                for party in (trade['party1'], trade['party2']):
+                                        validator.check_trade(time, traders[party], trade['price'])
+                                        traders[party].bookkeep(trade, order, bookkeep_verbose, time)
                                 if dump_each_trade: trade_stats(sess_id, traders, tdump, time, exchange.publish_lob(time, lob_verbose))
 
                         # traders respond to whatever happened
@@ -1206,10 +1238,15 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
 
 if __name__ == "__main__":
 
+        # the ratio sweep (trader types, population size, trials) comes from a definition file,
+        # optionally followed by a shard index and shard count, e.g. python BSE.py sweeps/BSE.json 0 4
+        sweep_fname, shard_index, n_shards = sweep.sweep_args(sys.argv, 'sweeps/BSE.json')
+        sweep_def = sweep.load_sweep(sweep_fname)
+
         # set up parameters for the session
 
-        start_time = 0.0
-        end_time = 600.0
+        start_time = sweep_def['start_time']
+        end_time = sweep_def['end_time']
         duration = end_time - start_time
 
 
@@ -1276,44 +1313,30 @@ if __name__ == "__main__":
         # NB this has weakness of symmetric proportions on buyers/sellers -- combinatorics of varying that are quite nasty
         
 
-        n_trader_types = 4
-        equal_ratio_n = 4
-        n_trials_per_ratio = 50
-
-        n_traders = n_trader_types * equal_ratio_n
-
-        fname = 'balances_%03d.csv' % equal_ratio_n
+        fname = sweep.shard_fname(sweep_def['results'], shard_index, n_shards)
 
         tdump = open(fname, 'w')
 
-        min_n = 1
+        price_quantiser = quantiser.from_setting(sweep_def['price_quantiser'], ticksize, bse_sys_minprice, bse_sys_maxprice)
+
+        # one validator for the whole run, so the violations of every session end up in one file
+        validator = validation.Validator(sweep_def['validation'])
 
         trialnumber = 1
-        trdr_1_n = min_n
-        while trdr_1_n <= n_traders:
-                trdr_2_n = min_n 
-                while trdr_2_n <= n_traders - trdr_1_n:
-                        trdr_3_n = min_n
-                        while trdr_3_n <= n_traders - (trdr_1_n + trdr_2_n):
-                                trdr_4_n = n_traders - (trdr_1_n + trdr_2_n + trdr_3_n)
-                                if trdr_4_n >= min_n:
-                                        buyers_spec = [('GVWY', trdr_1_n), ('SHVR', trdr_2_n),
-                                                       ('ZIC', trdr_3_n), ('ZIP', trdr_4_n)]
-                                        sellers_spec = buyers_spec
-                                        traders_spec = {'sellers':sellers_spec, 'buyers':buyers_spec}
-                                        # print buyers_spec
-                                        trial = 1
-                                        while trial <= n_trials_per_ratio:
-                                                trial_id = 'trial%07d' % trialnumber
-                                                market_session(trial_id, start_time, end_time, traders_spec,
-                                                               order_sched, tdump, False, True)
-                                                tdump.flush()
-                                                trial = trial + 1
-                                                trialnumber = trialnumber + 1
-                                trdr_3_n += 1
-                        trdr_2_n += 1
-                trdr_1_n += 1
+        for task in sweep.select(sweep.sweep_trials(sweep_def), shard_index, n_shards):
+                buyers_spec = task['config']['spec']
+                sellers_spec = buyers_spec
+                traders_spec = {'sellers':sellers_spec, 'buyers':buyers_spec}
+                trial_id = 'trial%07d' % task['trialnumber']
+                market_session(trial_id, start_time, end_time, traders_spec,
+                               order_sched, tdump, False, True, validator)
+                tdump.flush()
+                trialnumber = task['trialnumber'] + 1
         tdump.close()
+        if len(validator.violations) > 0:
+                violations_fname = sweep.shard_fname('profit_violations.csv', shard_index, n_shards)
+                validator.write(violations_fname)
+                print('%d profit-invariant violations, written to %s' % (len(validator.violations), violations_fname))
         
         print(trialnumber)
 
@@ -16,13 +16,100 @@ AA order execution strategy as described in: "Perukrishnen, Cliff and Jennings (
     - Includes functions for using Newton-Rhapson method for finding 
       complementary theta values.
 
+    Runs as the AA engine of borsim.py when borsim.aa_engine is 'ema' (see populate_market).
+    With borsim.aa_batch_newton, the theta estimates of all the AA traders of a market are
+    solved together by newton_batch() once per market event (AAPopulation).
+
 '''
 import math
 import random
 
-class Trader_AA(object):
+# numpy is optional: it is only needed for the batched Newton-Raphson solver
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from borsim import Trader, Order, Population, bse_sys_maxprice
+
 
-    def __init__(self):
+def newton_batch(theta, a, b, maxNewtonItter, maxNewtonError):
+    # newton4Buying/newton4Selling for arrays of traders at once: solves
+    #     theta_est * a / (exp(theta_est) - 1) = theta * b / (exp(theta) - 1)
+    # from theta_est = theta, with a = eqlbm, b = limit - eqlbm for buying and
+    # a = marketMax - eqlbm, b = eqlbm - limit for selling. The arrays can come from any
+    # number of traders, or sessions run in lockstep; each element stops iterating on its own
+    # once it has converged.
+    theta = np.asarray(theta, dtype=float)
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    # a diverging element overflows to inf/nan and then stops, where the scalar version would raise
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        rightHside = (theta * b) / (np.exp(theta) - 1)
+        theta_est = theta.copy()
+        active = np.ones(len(theta_est), dtype=bool)
+        i = 0
+        while i <= maxNewtonItter and active.any():
+            idx = np.flatnonzero(active)
+            x = theta_est[idx]
+            eX = np.exp(x)
+            eXminOne = eX - 1
+            fofX = (((x * a[idx]) / eXminOne) - rightHside[idx])
+            dfofX = ((a[idx] / eXminOne) - ((eX * a[idx] * x) / (eXminOne * eXminOne)))
+            # converged (or stuck) elements drop out, the others take a Newton step
+            step = (np.abs(fofX) > maxNewtonError) & (dfofX != 0)
+            theta_est[idx[step]] = x[step] - (fofX[step] / dfofX[step])
+            active[idx[~step]] = False
+            i += 1
+    theta_est[theta_est == 0.0] += 0.000001
+    return theta_est
+
+
+class AAPopulation(Population):
+    # The AA traders of a market. Their own respond() leaves out the target update, which is
+    # done here once per event with all the theta estimates from one newton_batch() call.
+
+    def __init__(self, traders):
+        Population.__init__(self, traders)
+        for t in self.traders:
+            t.batched = True
+
+    def respond(self, time, lob, trade, verbose):
+        ready = [t for t in self.traders if t.limit != None and t.eqlbm != None]
+        # updateTarget only needs an estimate for an intra-marginal side with negative aggressiveness
+        buyers = [t for t in ready if not t.limit < t.eqlbm and t.aggressiveness_buy < 0]
+        sellers = [t for t in ready if not t.limit > t.eqlbm and t.aggressiveness_sell < 0]
+        theta_buy = {}
+        theta_sell = {}
+        if len(buyers) > 0:
+            limit = np.array([t.limit for t in buyers], dtype=float)
+            eqlbm = np.array([t.eqlbm for t in buyers], dtype=float)
+            theta_est = newton_batch([t.theta for t in buyers], eqlbm, limit - eqlbm,
+                                     buyers[0].maxNewtonItter, buyers[0].maxNewtonError)
+            for i in range(len(buyers)):
+                theta_buy[buyers[i].tid] = float(theta_est[i])
+        if len(sellers) > 0:
+            limit = np.array([t.limit for t in sellers], dtype=float)
+            eqlbm = np.array([t.eqlbm for t in sellers], dtype=float)
+            marketMax = np.array([t.marketMax for t in sellers], dtype=float)
+            theta_est = newton_batch([t.theta for t in sellers], marketMax - eqlbm, eqlbm - limit,
+                                     sellers[0].maxNewtonItter, sellers[0].maxNewtonError)
+            for i in range(len(sellers)):
+                theta_sell[sellers[i].tid] = float(theta_est[i])
+        for t in self.traders:
+            t.updateTarget(theta_buy.get(t.tid), theta_sell.get(t.tid))
+
+class Trader_AA(Trader):
+
+    __slots__ = ('spin_up_time', 'eta', 'theta_max', 'theta_min', 'lambda_a', 'lambda_r', 'beta_1', 'beta_2',
+                 'gamma', 'nLastTrades', 'ema_param', 'maxNewtonItter', 'maxNewtonError', 'limit', 'active',
+                 'job', 'marketMax', 'prev_best_bid_p', 'prev_best_bid_q', 'prev_best_ask_p',
+                 'prev_best_ask_q', 'eqlbm', 'theta', 'smithsAlpha', 'lastTrades', 'smithsAlphaMin',
+                 'smithsAlphaMax', 'aggressiveness_buy', 'aggressiveness_sell', 'target_buy', 'target_sell',
+                 'batched')
+
+    def __init__(self, ttype, tid, balance, time):
+        Trader.__init__(self, ttype, tid, balance, time)
 
         # External parameters (you must choose [optimise] values yourselves)
         self.spin_up_time = 20
@@ -65,6 +152,9 @@ class Trader_AA(object):
         self.target_buy = None
         self.target_sell = None
 
+        # True when an AAPopulation does the target update at the end of respond()
+        self.batched = False
+
     def updateEq(self, price):
         # Updates the equilibrium price estimate using EMA
         if self.eqlbm == None: self.eqlbm = price
@@ -83,6 +173,7 @@ class Trader_AA(object):
             if abs(fofX) <= self.maxNewtonError:
                 break
             dfofX = ((self.eqlbm / eXminOne) - ((eX * self.eqlbm * theta_est) / float(eXminOne * eXminOne)))
+            if dfofX == 0: break
             theta_est = (theta_est - (fofX / float(dfofX)));
             i += 1
         if theta_est == 0.0: theta_est += 0.000001
@@ -101,13 +192,23 @@ class Trader_AA(object):
             if abs(fofX) <= self.maxNewtonError:
                 break
             dfofX = (((self.marketMax - self.eqlbm) / eXminOne) - ((eX * (self.marketMax - self.eqlbm) * theta_est) / float(eXminOne * eXminOne)))
+            if dfofX == 0: break
             theta_est = (theta_est - (fofX / float(dfofX)))
             i += 1
         if theta_est == 0.0: theta_est += 0.000001
         return theta_est
         
-    def updateTarget(self):
+    def updateTarget(self, theta_est_buy=None, theta_est_sell=None):
         # relates to eqns (3),(4),(5) and (6)
+        # theta_est_buy/theta_est_sell are the Newton-Raphson estimates if already solved (by AAPopulation)
+        if self.limit == None:
+            # no customer order yet
+            return
+        if self.eqlbm == None:
+            # no trades seen yet, so no equilibrium estimate: aim at the limit price
+            self.target_buy = self.limit
+            self.target_sell = self.limit
+            return
         # For buying
         if self.limit < self.eqlbm:
             # Extra-marginal buyer
@@ -118,7 +219,8 @@ class Trader_AA(object):
             # Intra-marginal buyer
             if self.aggressiveness_buy >= 0: target = (self.eqlbm + (self.limit - self.eqlbm) * ((math.exp(self.aggressiveness_buy * self.theta) - 1) / float(math.exp(self.theta) - 1)))
             else:
-                theta_est = self.newton4Buying()
+                theta_est = theta_est_buy
+                if theta_est == None: theta_est = self.newton4Buying()
                 target = self.eqlbm * (1 - (math.exp(-self.aggressiveness_buy * theta_est) - 1) / float(math.exp(theta_est) - 1))
             self.target_buy = target
         # For selling
@@ -131,7 +233,8 @@ class Trader_AA(object):
             # Intra-marginal seller
             if self.aggressiveness_sell >= 0: target = self.limit + (self.eqlbm - self.limit) * (1 - (math.exp(self.aggressiveness_sell * self.theta) - 1) / float(math.exp(self.theta) - 1))
             else:
-                theta_est = self.newton4Selling() 
+                theta_est = theta_est_sell
+                if theta_est == None: theta_est = self.newton4Selling()
                 target = self.eqlbm + (self.marketMax - self.eqlbm) * ((math.exp(-self.aggressiveness_sell * theta_est) - 1) / (math.exp(theta_est) - 1))
             self.target_sell = target
     
@@ -178,13 +281,17 @@ class Trader_AA(object):
         self.smithsAlpha = math.sqrt(sum(((p - self.eqlbm) ** 2) for p in self.lastTrades) * (1 / float(len(self.lastTrades)))) / self.eqlbm
         if self.smithsAlphaMin == None:
             self.smithsAlphaMin = self.smithsAlpha
-            self.smithsAlphaMax = self.smithsAlphaMax
+            self.smithsAlphaMax = self.smithsAlpha
         else:
             if self.smithsAlpha < self.smithsAlphaMin: self.smithsAlphaMin = self.smithsAlpha
             if self.smithsAlpha > self.smithsAlphaMax: self.smithsAlphaMax = self.smithsAlpha
         
     def updateTheta(self):
-        alphaBar = (self.smithsAlpha - self.smithsAlphaMin) / (self.smithsAlphaMax - self.smithsAlphaMin)
+        if self.smithsAlphaMax == self.smithsAlphaMin:
+            # only one distinct alpha so far
+            alphaBar = 0.4
+        else:
+            alphaBar = (self.smithsAlpha - self.smithsAlphaMin) / (self.smithsAlphaMax - self.smithsAlphaMin)
         desiredTheta = (self.theta_max - self.theta_min) * (1 - (alphaBar * math.exp(self.gamma * (alphaBar - 1)))) + self.theta_min
         theta = self.theta + self.beta_2 * (desiredTheta - self.theta)
         if theta == 0: theta += 0.0000001
@@ -199,22 +306,32 @@ class Trader_AA(object):
             self.limit = self.orders[0].price
             self.job = self.orders[0].otype
             self.updateTarget()
+            # an empty side of the LOB counts as the edge of the price range
+            if self.prev_best_bid_p == None: best_bid = 0
+            else: best_bid = self.prev_best_bid_p
+            if self.prev_best_ask_p == None: best_ask = self.marketMax
+            else: best_ask = self.prev_best_ask_p
             if self.job == 'Bid':
                 # currently a buyer (working a bid order)
                 if self.spin_up_time > 0:
-                    ask_plus = (1 + self.lambda_r) * self.prev_best_ask_p + self.lambda_a
-                    quoteprice = self.prev_best_bid_p + (min(self.limit, ask_plus) - self.prev_best_bid_p) / self.eta
+                    ask_plus = (1 + self.lambda_r) * best_ask + self.lambda_a
+                    quoteprice = best_bid + (min(self.limit, ask_plus) - best_bid) / self.eta
                 else:
-                    quoteprice = self.prev_best_bid_p + (self.target - self.prev_best_bid_p) / self.eta
+                    quoteprice = best_bid + (self.target_buy - best_bid) / self.eta
+                # never bid above the limit price
+                if quoteprice > self.limit: quoteprice = self.limit
             else:
                 # currently a seller (working a sell order)
                 if self.spin_up_time > 0:
-                    bid_minus = (1 - self.lambda_r) * self.prev_best_bid_p - self.lambda_a
-                    quoteprice = self.prev_best_ask_p - (self.prev_best_ask_p - max(self.limit, bid_minus)) / self.eta
+                    bid_minus = (1 - self.lambda_r) * best_bid - self.lambda_a
+                    quoteprice = best_ask - (best_ask - max(self.limit, bid_minus)) / self.eta
                 else:
-                    quoteprice = (self.prev_best_ask_p - (self.prev_best_ask_p - self.target) / self.eta)
+                    quoteprice = (best_ask - (best_ask - self.target_sell) / self.eta)
+                # never ask below the limit price
+                if quoteprice < self.limit: quoteprice = self.limit
         
-            order = Order(self.tid, self.job, quoteprice, self.orders[0].qty, time)
+            order = Order(self.tid, self.job, quoteprice, self.orders[0].qty, time, lob['QID'])
+            self.lastquote = order
         
         return order             
             
@@ -236,8 +353,9 @@ class Trader_AA(object):
                 # previous best bid was hit
                 bid_hit = True
         elif self.prev_best_bid_p != None:
-            # the bid LOB has been emptied by a hit
-                bid_hit = True
+            # the bid LOB has been emptied: was it cancelled or hit?
+            if lob['tape'][-1]['type'] == 'Cancel': bid_hit = False
+            else: bid_hit = True
 
         # what, if anything, has happened on the ask LOB?
         ask_improved = False
@@ -254,15 +372,18 @@ class Trader_AA(object):
                 # trade happened and best ask price has got worse, or stayed same but quantity reduced -- assume previous best ask was lifted
                 ask_lifted = True
         elif self.prev_best_ask_p != None:
-            # the bid LOB is empty now but was not previously, so must have been hit
-            ask_lifted = True
+            # the ask LOB is empty now but was not previously: cancelled or lifted?
+            if lob['tape'][-1]['type'] == 'Cancel': ask_lifted = False
+            else: ask_lifted = True
 
         if verbose and (bid_improved or bid_hit or ask_improved or ask_lifted):
             print ('B_improved', bid_improved, 'B_hit', bid_hit, 'A_improved', ask_improved, 'A_lifted', ask_lifted)
 
-        deal = bid_hit or ask_lifted
+        deal = (bid_hit or ask_lifted) and trade != None
         self.prev_best_bid_p = lob_best_bid_p
+        self.prev_best_bid_q = lob_best_bid_q
         self.prev_best_ask_p = lob_best_ask_p
+        self.prev_best_ask_q = lob_best_ask_q
         
         
         if self.spin_up_time > 0: self.spin_up_time -= 1
@@ -275,17 +396,19 @@ class Trader_AA(object):
         # The lines below represent the rules in fig(7) in AIJ08. The if statements have not
         # been merged for the sake of clarity.
         
-        # For buying
-        if deal:
-            if self.target >= price: 
-                self.aggressiveness_buy = self.updateAgg(False, True, price)
-            else: self.aggressiveness_buy = self.updateAgg(True, True, price)
-        elif bid_improved and (self.target <= price): self.aggressiveness_buy = self.updateAgg(True, True, self.prev_best_bid_p)
-        # For selling
-        if deal:
-            if self.target <= price:  self.aggressiveness_sell = self.updateAgg(False, False, price)
-            else: self.aggressiveness_sell = self.updateAgg(True, False, price)
-        elif ask_improved and (self.target >= price): self.aggressiveness_sell = self.updateAgg(True, False, self.prev_best_ask_p)
+        # Without an equilibrium estimate and targets there is nothing to adapt yet.
+        if self.eqlbm != None and self.limit != None and self.target_buy != None:
+            # For buying
+            if deal:
+                if self.target_buy >= price: 
+                    self.aggressiveness_buy = self.updateAgg(False, True, price)
+                else: self.aggressiveness_buy = self.updateAgg(True, True, price)
+            elif bid_improved and (self.target_buy <= self.prev_best_bid_p): self.aggressiveness_buy = self.updateAgg(True, True, self.prev_best_bid_p)
+            # For selling
+            if deal:
+                if self.target_sell <= price:  self.aggressiveness_sell = self.updateAgg(False, False, price)
+                else: self.aggressiveness_sell = self.updateAgg(True, False, price)
+            elif ask_improved and (self.target_sell >= self.prev_best_ask_p): self.aggressiveness_sell = self.updateAgg(True, False, self.prev_best_ask_p)
         
-        self.updateTarget()
+        if not self.batched: self.updateTarget()
         
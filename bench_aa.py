@@ -0,0 +1,113 @@
+'''
+Benchmark of the two AA engines of borsim.py: borsim's own Trader_AA and Ash Booth's EMA version
+in Trader_AA.py (see borsim.aa_engine).
+
+Both engines trade the same seeded sessions against the same opponents, and for each mix the
+script reports the AA profit per trader (mean and standard error over the sessions) and the
+cost of an AA getorder() and respond() call.
+
+    python bench_aa.py [sweep file] [sessions per mix]
+
+The order schedule and session length come from the sweep file (sweeps/borsim.json by default).
+'''
+import math
+import os
+import random
+import sys
+import timeit
+
+import borsim
+import sweep
+import Trader_AA as aa_ema
+
+
+engines = [('borsim', borsim.Trader_AA), ('ema', aa_ema.Trader_AA)]
+mixes = [[('AA', 6), ('ZIC', 6)],
+         [('AA', 6), ('ZIP', 6)],
+         [('AA', 4), ('GDX', 4), ('ZIP', 4)]]
+
+
+# wrap getorder() and respond() of an AA class so that their calls are counted and timed
+def time_calls(cls, calls):
+    getorder = cls.__dict__['getorder']
+    respond = cls.__dict__['respond']
+
+    def timed_getorder(self, time, countdown, lob):
+        t0 = timeit.default_timer()
+        order = getorder(self, time, countdown, lob)
+        calls['getorder'][0] += 1
+        calls['getorder'][1] += timeit.default_timer() - t0
+        return order
+
+    def timed_respond(self, time, lob, trade, verbose):
+        t0 = timeit.default_timer()
+        respond(self, time, lob, trade, verbose)
+        calls['respond'][0] += 1
+        calls['respond'][1] += timeit.default_timer() - t0
+
+    cls.getorder = timed_getorder
+    cls.respond = timed_respond
+    return getorder, respond
+
+
+# the AA profit per trader of each session of a mix, and the call counts and times of the AA methods
+def bench_engine(engine, cls, spec, order_sched, start_time, end_time, n_sessions, dumpfile):
+    borsim.aa_engine = engine
+    calls = {'getorder': [0, 0.0], 'respond': [0, 0.0]}
+    getorder, respond = time_calls(cls, calls)
+    profits = []
+    try:
+        for session in range(n_sessions):
+            random.seed(session)
+            types, avg_balances = borsim.market_session('%s-%03d' % (engine, session), start_time, end_time,
+                                                        {'buyers': spec, 'sellers': spec}, order_sched,
+                                                        dumpfile, False, False)
+            profits.append(avg_balances[types.index('AA')])
+    finally:
+        cls.getorder = getorder
+        cls.respond = respond
+    return profits, calls
+
+
+def mean_stderr(values):
+    n = len(values)
+    mean = sum(values) / float(n)
+    if n < 2:
+        return mean, 0.0
+    variance = sum([(v - mean) ** 2 for v in values]) / (n - 1)
+    return mean, math.sqrt(variance / n)
+
+
+if __name__ == "__main__":
+    sweep_fname = 'sweeps/borsim.json'
+    n_sessions = 20
+    if len(sys.argv) > 1:
+        sweep_fname = sys.argv[1]
+    if len(sys.argv) > 2:
+        n_sessions = int(sys.argv[2])
+    sweep_def = sweep.load_sweep(sweep_fname)
+
+    schedule_source = sweep_def['schedule']
+    if schedule_source['source'] == 'random':
+        random.seed(0)
+        order_sched = borsim.random_order_schedule(**schedule_source['params'])
+    elif schedule_source['source'] == 'file':
+        order_sched = sweep.load_schedule(schedule_source['path'])
+    else:
+        sys.exit('FATAL: bench_aa needs a random or file schedule, not %s' % schedule_source['source'])
+
+    dumpfile = open(os.devnull, 'w')
+    print('%-24s %-7s %12s %10s %14s %14s' % ('mix', 'engine', 'AA profit', 'stderr', 'getorder us', 'respond us'))
+    for spec in mixes:
+        mix_name = '+'.join(['%s%d' % (ttype, n) for (ttype, n) in spec])
+        for (engine, cls) in engines:
+            profits, calls = bench_engine(engine, cls, spec, order_sched, sweep_def['start_time'],
+                                          sweep_def['end_time'], n_sessions, dumpfile)
+            mean, stderr = mean_stderr(profits)
+            per_call = {}
+            for method in calls:
+                (n_calls, total) = calls[method]
+                per_call[method] = 1e6 * total / max(n_calls, 1)
+            print('%-24s %-7s %12.2f %10.2f %14.1f %14.1f' % (mix_name, engine, mean, stderr,
+                                                             per_call['getorder'], per_call['respond']))
+    dumpfile.close()
@@ -0,0 +1,79 @@
+'''
+Check and benchmark of borsim's StatelessPopulation (see borsim.stateless_population), which skips
+the empty respond() calls of the Giveaway, ZIC, Shaver and Sniper traders of a market.
+
+The same seeded sessions are run with and without the population; they must end with the same
+balances. For each mix the script reports whether they did, and the time per session of both runs.
+
+    python bench_stateless.py [sweep file] [sessions per mix]
+
+The order schedule and session length come from the sweep file (sweeps/borsim.json by default).
+'''
+import os
+import random
+import sys
+import timeit
+
+import borsim
+import sweep
+
+
+mixes = [[('GVWY', 10), ('ZIC', 10), ('SHVR', 10), ('SNPR', 10)],
+         [('SHVR', 20), ('ZIP', 10)],
+         [('ZIC', 10), ('SNPR', 10), ('AA', 10)]]
+
+
+# runs the sessions with or without the population; returns their balances and the time they took
+def time_sessions(population, spec, order_sched, start_time, end_time, n_sessions, dumpfile):
+    borsim.stateless_population = population
+    balances = []
+    t0 = timeit.default_timer()
+    try:
+        for session in range(n_sessions):
+            random.seed(session)
+            types, avg_balances = borsim.market_session('stateless-%03d' % session, start_time, end_time,
+                                                        {'buyers': spec, 'sellers': spec}, order_sched,
+                                                        dumpfile, False, False)
+            balances.append(dict(zip(types, avg_balances)))
+    finally:
+        borsim.stateless_population = False
+    return balances, timeit.default_timer() - t0
+
+
+if __name__ == "__main__":
+    sweep_fname = 'sweeps/borsim.json'
+    n_sessions = 5
+    if len(sys.argv) > 1:
+        sweep_fname = sys.argv[1]
+    if len(sys.argv) > 2:
+        n_sessions = int(sys.argv[2])
+    sweep_def = sweep.load_sweep(sweep_fname)
+
+    schedule_source = sweep_def['schedule']
+    if schedule_source['source'] == 'random':
+        random.seed(0)
+        order_sched = borsim.random_order_schedule(**schedule_source['params'])
+    elif schedule_source['source'] == 'file':
+        order_sched = sweep.load_schedule(schedule_source['path'])
+    else:
+        sys.exit('FATAL: bench_stateless needs a random or file schedule, not %s' % schedule_source['source'])
+
+    borsim.tape_fname = None
+    start_time = sweep_def['start_time']
+    end_time = sweep_def['end_time']
+    dumpfile = open(os.devnull, 'w')
+    print('%-28s %9s %14s %14s' % ('mix', 'balances', 'traders s', 'population s'))
+    failed = False
+    for spec in mixes:
+        mix_name = '+'.join(['%s%d' % (ttype, n) for (ttype, n) in spec])
+        (traders_balances, traders_time) = time_sessions(False, spec, order_sched, start_time, end_time,
+                                                         n_sessions, dumpfile)
+        (population_balances, population_time) = time_sessions(True, spec, order_sched, start_time, end_time,
+                                                               n_sessions, dumpfile)
+        same_balances = traders_balances == population_balances
+        print('%-28s %9s %14.2f %14.2f' % (mix_name, ['differ', 'same'][same_balances],
+                                           traders_time / n_sessions, population_time / n_sessions))
+        failed = failed or not same_balances
+    dumpfile.close()
+    if failed:
+        sys.exit('FATAL: sessions with StatelessPopulation end with different balances')
@@ -58,11 +58,75 @@
 import sys
 import math
 import random
+import bisect
+import collections
+import functools
+import itertools
+
+# numpy is optional; without it these settings fall back to the plain Python code:
+# GDX evaluates its price grids one price at a time, and random_blocks (RandomStream),
+# zip_population (ZIPPopulation) and aa_batch_newton are ignored
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import quantiser
+import registry
+import results
+import sweep
+import tradehistory
+import validation
+
+# run as a script this module is __main__, but strategy modules such as Trader_AA.py import their base
+# classes and settings from borsim: make that name refer to this module rather than load a second copy
+if __name__ == '__main__':
+    sys.modules['borsim'] = sys.modules[__name__]
 
 bse_sys_minprice = 1  # minimum price in the system, in cents/pennies
 bse_sys_maxprice = 1000  # maximum price in the system, in cents/pennies
 ticksize = 1  # minimum change in price, in cents/pennies
 
+# where the trading strategies get their random numbers: the random module, or with random_blocks a
+# RandomStream that market_session() starts for every session, seeded from the random module
+# (so a seeded run is still reproducible, but draws different numbers than without random_blocks);
+# set from the sweep's "random_blocks"
+random_blocks = False
+random_block_size = 4096
+rng = random
+
+
+# Uniform random numbers drawn from numpy in blocks of block_size and handed out one at a time;
+# random(), uniform() and randint() stand in for the random module's functions of the same name
+class RandomStream:
+
+    def __init__(self, seed, block_size=4096):
+        self.generator = np.random.RandomState(seed)
+        self.block_size = block_size
+        # random() is next() on an iterator over the blocks, so a draw costs no more than random.random()
+        self.random = functools.partial(next, itertools.chain.from_iterable(self.blocks()))
+
+    # the blocks of uniforms, drawn when the previous one runs out; handed out as lists,
+    # whose items are cheaper to take than numpy scalars
+    def blocks(self):
+        while True:
+            yield self.generator.random_sample(self.block_size).tolist()
+
+    def uniform(self, a, b):
+        return a + (b - a) * self.random()
+
+    # an integer in a..b inclusive
+    def randint(self, a, b):
+        return a + int(self.random() * (b - a + 1))
+
+
+# the profit-invariant checks (see validation.py) of sessions that are not handed a Validator:
+# validation_mode 'always', 'sampled' (one in every validation_sample_every) or 'off'. Failed checks
+# are collected by the validator, unless validation_fatal is set, which ends the run as the old checks did.
+validation_mode = 'always'
+validation_sample_every = 100
+validation_fatal = False
+
 
 # an Order/quote has a trader id, a type (buy/sell) price, quantity, timestamp, and unique i.d.
 class Order:
@@ -202,6 +266,11 @@ class Orderbook_half:
         return best_price_counterparty
 
 
+# how the exchange puts quote prices on the tick grid: None takes prices as the traders quote them,
+# or a quantiser.PriceQuantiser that rounds them before they reach the book (see the sweep's price_quantiser)
+price_quantiser = None
+
+
 # Orderbook for a single instrument: list of bids and list of asks
 
 class Orderbook(Orderbook_half):
@@ -210,7 +279,9 @@ class Orderbook(Orderbook_half):
         self.bids = Orderbook_half('Bid', bse_sys_minprice)
         self.asks = Orderbook_half('Ask', bse_sys_maxprice)
         self.tape = []
+        self.history = tradehistory.TradeHistory()  # the trades on the tape, indexed by time
         self.quote_id = 0  # unique ID code for each quote accepted onto the book
+        self.quantiser = price_quantiser
 
 
 # Exchange's internal orderbook
@@ -265,6 +336,11 @@ class Exchange(Orderbook):
             # neither bid nor ask?
             sys.exit('bad order type in del_quote()')
 
+    # put an order's price on the quantiser's grid, before it is checked and sent to process_order2()
+    def quantise(self, order):
+        if self.quantiser != None:
+            order.price = self.quantiser.quantise(order.price, order.otype)
+
     def process_order2(self, time, order, verbose):
         # receive an order and either add it to the relevant LOB (ie treat as limit order)
         # or if it crosses the best counterparty offer, execute it (treat as a market order)
@@ -319,6 +395,7 @@ class Exchange(Orderbook):
                                   'qty': order.qty
                                   }
             self.tape.append(transaction_record)
+            self.history.record(time, price, order.qty)
             return transaction_record
         else:
             return None
@@ -347,6 +424,7 @@ class Exchange(Orderbook):
                                'lob': self.asks.lob_anon}
         public_data['QID'] = self.quote_id
         public_data['tape'] = self.tape
+        public_data['trades'] = self.history
         if verbose:
             print('publish_lob: t=%d' % time)
             print('BID_lob=%s' % public_data['bids']['lob'])
@@ -360,15 +438,56 @@ class Exchange(Orderbook):
 ##################--Traders below here--#############
 
 
+# what each trader keeps of its own trades (Trader.blotter):
+# 'full' keeps every trade record, 'window' the last blotter_window of them,
+# and 'aggregate' only the number of trades, their total profit and the times of the first and last
+# (set from the sweep's "blotter_mode")
+blotter_mode = 'full'
+blotter_window = 100
+
+
+# an empty blotter for the current blotter_mode
+def new_blotter():
+    if blotter_mode == 'full':
+        return []
+    elif blotter_mode == 'window':
+        return collections.deque(maxlen=blotter_window)
+    elif blotter_mode == 'aggregate':
+        return {'n': 0, 'profit': 0, 'first_time': None, 'last_time': None}
+    else:
+        sys.exit('FATAL: unknown blotter mode %s' % blotter_mode)
+
+
+# add one trade and the profit made on it to a blotter made by new_blotter()
+def record_trade(blotter, trade, profit):
+    if isinstance(blotter, dict):
+        blotter['n'] += 1
+        blotter['profit'] += profit
+        if blotter['first_time'] is None:
+            blotter['first_time'] = trade['time']
+        blotter['last_time'] = trade['time']
+    else:
+        blotter.append(trade)
+
+
+# robot type -> trader class, filled in as the trader classes below are defined (see registry.py)
+trader_registry = registry.TraderRegistry()
+
+
 # Trader superclass
 # all Traders have a trader id, bank balance, blotter, and list of orders to execute
-class Trader:
+class Trader(object):
+
+    # traders have fixed attribute sets, so no per-instance __dict__ is kept; every subclass lists
+    # the attributes it adds in its own __slots__ (an empty tuple if it adds none)
+    __slots__ = ('ttype', 'tid', 'balance', 'blotter', 'orders', 'n_quotes', 'willing', 'able', 'birthtime',
+                 'profitpertime', 'n_trades', 'lastquote')
 
     def __init__(self, ttype, tid, balance, time):
         self.ttype = ttype  # what type / strategy this trader is
         self.tid = tid  # trader unique ID code
         self.balance = balance  # money in the bank
-        self.blotter = []  # record of trades executed
+        self.blotter = new_blotter()  # record of trades executed
         self.orders = []  # customer orders currently being worked (fixed at 1)
         self.n_quotes = 0  # number of quotes live on LOB
         self.willing = 1  # used in ZIP etc
@@ -405,7 +524,6 @@ class Trader:
         outstr = ""
         for order in self.orders: outstr = outstr + str(order)
 
-        self.blotter.append(trade)  # add trade record to trader's blotter
         # NB What follows is **LAZY** -- assumes all orders are quantity=1
         transactionprice = trade['price']
         if self.orders[0].otype == 'Bid':
@@ -413,18 +531,10 @@ class Trader:
         else:
             profit = transactionprice - self.orders[0].price
         self.balance += profit
+        record_trade(self.blotter, trade, profit)  # add trade record to trader's blotter
         self.n_trades += 1
         self.profitpertime = self.balance / (time - self.birthtime)
 
-        if profit < 0:
-            print
-            profit
-            print
-            trade
-            print
-            order
-            sys.exit()
-
         if verbose: print('%s profit=%d balance=%d profit/time=%d' % (outstr, profit, self.balance, self.profitpertime))
         self.del_order(order)  # delete the order
 
@@ -438,12 +548,43 @@ class Trader:
     def mutate(self, time, lob, trade, verbose):
         return None
 
+    # the time from which this trader may quote in a session from starttime to endtime;
+    # before it, getorder() would return None whatever the market, so the trader need not be asked
+    def wakeup_time(self, starttime, endtime):
+        return starttime
+
+
+# A group of traders whose response to a market event is (partly) computed for all of them at once.
+# market_session() calls each population's respond() once per event, after every trader's own respond().
+class Population:
+
+    # True when the population does the traders' whole respond(), so theirs is not called at all
+    replaces_respond = False
+    # True when market_session() gets the traders' quotes from the population's getorder() instead of theirs
+    replaces_getorder = False
+
+    def __init__(self, traders):
+        self.traders = traders
+
+    # the quote (Order or None) of the trader at index i of self.traders
+    def getorder(self, i, time, countdown, lob):
+        return self.traders[i].getorder(time, countdown, lob)
+
+    # the quotes of the traders at the given indices, in that order
+    def getorders(self, indices, time, countdown, lob):
+        return [self.getorder(i, time, countdown, lob) for i in indices]
+
+    def respond(self, time, lob, trade, verbose):
+        return None
+
 
 # Trader subclass Giveaway
 # even dumber than a ZI-U: just give the deal away
 # (but never makes a loss)
 class Trader_Giveaway(Trader):
 
+    __slots__ = ()
+
     def getorder(self, time, countdown, lob):
         if len(self.orders) < 1:
             order = None
@@ -457,8 +598,57 @@ class Trader_Giveaway(Trader):
             self.lastquote = order
         return order
 
+
+trader_registry.register('GVWY', Trader_Giveaway)
+
+
+# belief of GDX's belief functions on arrays of counts: for, against -> for / (for + against), or 0 if no counts
+# the division is the same one the scalar functions do, so it is integer division under Python 2
+def grid_belief(n_for, n_against):
+    total = n_for + n_against
+    return np.where(total == 0, 0, n_for / np.maximum(total, 1))
+
+
+# the records of GDX's price scans on a whole array of returns: the index of the first return strictly above
+# floor that is never beaten, and of the record it replaced (None where there is no such index)
+def grid_records(returns, floor):
+    if len(returns) == 0:
+        return None, None
+    best = int(np.argmax(returns))
+    if returns[best] <= floor:
+        return None, None
+    if best == 0:
+        return best, None
+    second = int(np.argmax(returns[:best]))
+    if returns[second] <= floor:
+        return best, None
+    return best, second
+
+
+# how much trade history GDX traders base their beliefs on:
+# 'full' keeps every accepted bid and ask, 'window' the last gdx_memory_window of each,
+# and 'time' those accepted in the last gdx_memory_horizon seconds (set from the sweep's "gdx_memory")
+gdx_memory = 'full'
+gdx_memory_window = 100
+gdx_memory_horizon = 120.0
+
+
+# drop the oldest price of an accepted-price history, together with its time and its entry in the sorted index
+def forget_oldest(history, times, sorted_prices):
+    price = history.popleft()
+    times.popleft()
+    del sorted_prices[bisect.bisect_left(sorted_prices, price)]
+
+
 class Trader_GDX(Trader):
 
+    __slots__ = ('prev_orders', 'job', 'active', 'outstanding_bids', 'outstanding_asks', 'accepted_asks',
+                 'accepted_bids', 'accepted_ask_times', 'accepted_bid_times', 'outstanding_bid_prices',
+                 'outstanding_ask_prices', 'sorted_accepted_asks', 'sorted_accepted_bids', 'memory',
+                 'memory_window', 'memory_horizon', 'price', 'prev_best_bid_p', 'prev_best_bid_q',
+                 'prev_best_ask_p', 'prev_best_ask_q', 'first_turn', 'gamma', 'holdings',
+                 'remaining_offer_ops', 'values', 'use_numpy', 'value_memo', 'limit')
+
     def __init__(self, ttype, tid, balance, time):
         self.ttype = ttype
         self.tid = tid
@@ -466,7 +656,7 @@ class Trader_GDX(Trader):
         self.birthtime = time
         self.profitpertime = 0
         self.n_trades = 0
-        self.blotter = []
+        self.blotter = new_blotter()
         self.orders = []
         self.prev_orders = []
         self.n_quotes = 0
@@ -477,8 +667,22 @@ class Trader_GDX(Trader):
         # memory of all bids and asks and accepted bids and asks
         self.outstanding_bids = []
         self.outstanding_asks = []
-        self.accepted_asks = []
-        self.accepted_bids = []
+        self.accepted_asks = collections.deque()
+        self.accepted_bids = collections.deque()
+        self.accepted_ask_times = collections.deque()
+        self.accepted_bid_times = collections.deque()
+        # the same prices kept sorted, so that beliefs are counted by binary search:
+        # the insertion point of a price in a sorted list is the number of entries below it
+        self.outstanding_bid_prices = []
+        self.outstanding_ask_prices = []
+        self.sorted_accepted_asks = []
+        self.sorted_accepted_bids = []
+        # which accepted prices are remembered (see gdx_memory)
+        self.memory = gdx_memory
+        self.memory_window = gdx_memory_window
+        self.memory_horizon = gdx_memory_horizon
+        if self.memory not in ('full', 'window', 'time'):
+            sys.exit('FATAL: unknown GDX memory policy %s' % self.memory)
 
         self.price = -1
 
@@ -496,6 +700,14 @@ class Trader_GDX(Trader):
         self.remaining_offer_ops = 10
         self.values = [[0 for n in range(self.remaining_offer_ops)] for m in range(self.holdings)]
 
+        # evaluate whole price grids with numpy when it is available (same prices as the scalar scans)
+        self.use_numpy = np != None
+
+        # value tables already computed in this session, shared by the GDX traders of a market
+        # (set up by populate_market); keyed by everything the table depends on, see values_key()
+        self.value_memo = None
+        self.limit = None
+
     def getorder(self, time, countdown, lob):
         if len(self.orders) < 1:
             self.active = False
@@ -519,6 +731,8 @@ class Trader_GDX(Trader):
         return order
 
     def calc_p_bid(self, m, n):
+        if self.use_numpy:
+            return self.calc_p_bid_grid(m, n)
         best_return = 0
         best_bid = 0
         second_best_return = 0
@@ -552,6 +766,8 @@ class Trader_GDX(Trader):
         return best_bid
 
     def calc_p_ask(self, m, n):
+        if self.use_numpy:
+            return self.calc_p_ask_grid(m, n)
         best_return = 0
         best_ask = self.limit
         second_best_return = 0
@@ -584,19 +800,93 @@ class Trader_GDX(Trader):
 
         return best_ask
 
+    # calc_p_bid with each scan done as one numpy evaluation over its grid of candidate prices
+    def calc_p_bid_grid(self, m, n):
+        best_return = 0
+        best_bid = 0
+        second_best_bid = 0
+
+        prices = np.arange(int(self.limit / 2)) * 2
+        returns = self.buy_returns(prices, m, n)
+        best, second = grid_records(returns, best_return)
+        if best != None:
+            best_return = returns[best]
+            best_bid = prices[best].item()
+        if second != None:
+            second_best_bid = prices[second].item()
+
+        if second_best_bid > best_bid:
+            a = second_best_bid
+            second_best_bid = best_bid
+            best_bid = a
+
+        prices = np.arange(int(second_best_bid), int(best_bid)) * 0.05 + second_best_bid
+        best, second = grid_records(self.buy_returns(prices, m, n), best_return)
+        if best != None:
+            best_bid = prices[best].item()
+
+        return best_bid
+
+    # calc_p_ask with each scan done as one numpy evaluation over its grid of candidate prices
+    def calc_p_ask_grid(self, m, n):
+        best_return = 0
+        best_ask = self.limit
+        second_best_ask = self.limit
+
+        prices = np.arange(int(self.limit / 2)) * 2 + self.limit
+        returns = self.sell_returns(prices, m, n)
+        best, second = grid_records(returns, best_return)
+        if best != None:
+            best_return = returns[best]
+            best_ask = prices[best].item()
+        if second != None:
+            second_best_ask = prices[second].item()
+
+        if second_best_ask > best_ask:
+            a = second_best_ask
+            second_best_ask = best_ask
+            best_ask = a
+
+        prices = np.arange(int(second_best_ask), int(best_ask)) * 0.05 + second_best_ask
+        best, second = grid_records(self.sell_returns(prices, m, n), best_return)
+        if best != None:
+            best_ask = prices[best].item()
+
+        return best_ask
+
+    # expected return of bidding at each of an array of prices (the expression in calc_p_bid)
+    def buy_returns(self, prices, m, n):
+        belief = self.belief_buy_grid(prices)
+        return belief * ((self.limit - prices) + self.gamma * self.values[m - 1][n - 1]) + (
+                    1 - belief * self.gamma * self.values[m][n - 1])
+
+    # expected return of asking at each of an array of prices (the expression in calc_p_ask)
+    def sell_returns(self, prices, m, n):
+        belief = self.belief_sell_grid(prices)
+        return belief * ((prices - self.limit) + self.gamma * self.values[m - 1][n - 1]) + (
+                    1 - belief * self.gamma * self.values[m][n - 1])
+
+    # belief_sell at an array of prices: the counts are cumulative counts of the sorted price lists
+    def belief_sell_grid(self, prices):
+        accepted_asks_greater = len(self.sorted_accepted_asks) - \
+                                np.searchsorted(np.asarray(self.sorted_accepted_asks), prices, 'left')
+        bids_greater = len(self.outstanding_bid_prices) - \
+                       np.searchsorted(np.asarray(self.outstanding_bid_prices), prices, 'left')
+        unaccepted_asks_lower = np.searchsorted(np.asarray(self.outstanding_ask_prices), prices, 'right')
+        return grid_belief(accepted_asks_greater + bids_greater, unaccepted_asks_lower)
+
+    # belief_buy at an array of prices
+    def belief_buy_grid(self, prices):
+        accepted_bids_lower = np.searchsorted(np.asarray(self.sorted_accepted_bids), prices, 'right')
+        asks_lower = np.searchsorted(np.asarray(self.outstanding_ask_prices), prices, 'right')
+        unaccepted_bids_greater = len(self.outstanding_bid_prices) - \
+                                  np.searchsorted(np.asarray(self.outstanding_bid_prices), prices, 'left')
+        return grid_belief(accepted_bids_lower + asks_lower, unaccepted_bids_greater)
+
     def belief_sell(self, price):
-        accepted_asks_greater = 0
-        bids_greater = 0
-        unaccepted_asks_lower = 0
-        for p in self.accepted_asks:
-            if p >= price:
-                accepted_asks_greater += 1
-        for p in [thing[0] for thing in self.outstanding_bids]:
-            if p >= price:
-                bids_greater += 1
-        for p in [thing[0] for thing in self.outstanding_asks]:
-            if p <= price:
-                unaccepted_asks_lower += 1
+        accepted_asks_greater = len(self.sorted_accepted_asks) - bisect.bisect_left(self.sorted_accepted_asks, price)
+        bids_greater = len(self.outstanding_bid_prices) - bisect.bisect_left(self.outstanding_bid_prices, price)
+        unaccepted_asks_lower = bisect.bisect_right(self.outstanding_ask_prices, price)
 
         if accepted_asks_greater + bids_greater + unaccepted_asks_lower == 0:
             return 0
@@ -604,25 +894,37 @@ class Trader_GDX(Trader):
                     accepted_asks_greater + bids_greater + unaccepted_asks_lower)
 
     def belief_buy(self, price):
-        accepted_bids_lower = 0
-        asks_lower = 0
-        unaccepted_bids_greater = 0
-        for p in self.accepted_bids:
-            if p <= price:
-                accepted_bids_lower += 1
-        for p in [thing[0] for thing in self.outstanding_asks]:
-            if p <= price:
-                asks_lower += 1
-        for p in [thing[0] for thing in self.outstanding_bids]:
-            if p >= price:
-                unaccepted_bids_greater += 1
+        accepted_bids_lower = bisect.bisect_right(self.sorted_accepted_bids, price)
+        asks_lower = bisect.bisect_right(self.outstanding_ask_prices, price)
+        unaccepted_bids_greater = len(self.outstanding_bid_prices) - bisect.bisect_left(self.outstanding_bid_prices, price)
         if accepted_bids_lower + asks_lower + unaccepted_bids_greater == 0:
             return 0
         return (accepted_bids_lower + asks_lower) / (accepted_bids_lower + asks_lower + unaccepted_bids_greater)
 
+    # drop the accepted bids and asks that the memory policy no longer keeps
+    def forget(self, time):
+        if self.memory == 'window':
+            while len(self.accepted_bids) > self.memory_window:
+                forget_oldest(self.accepted_bids, self.accepted_bid_times, self.sorted_accepted_bids)
+            while len(self.accepted_asks) > self.memory_window:
+                forget_oldest(self.accepted_asks, self.accepted_ask_times, self.sorted_accepted_asks)
+        elif self.memory == 'time':
+            while len(self.accepted_bid_times) > 0 and self.accepted_bid_times[0] < time - self.memory_horizon:
+                forget_oldest(self.accepted_bids, self.accepted_bid_times, self.sorted_accepted_bids)
+            while len(self.accepted_ask_times) > 0 and self.accepted_ask_times[0] < time - self.memory_horizon:
+                forget_oldest(self.accepted_asks, self.accepted_ask_times, self.sorted_accepted_asks)
+
+    # the inputs of the value table: job, limit and discount, table size, and the belief state
+    # (a different belief state is a different key, so stale tables are never reused)
+    def values_key(self):
+        return (self.job, self.limit, self.gamma, self.holdings, self.remaining_offer_ops,
+                tuple(self.sorted_accepted_bids), tuple(self.sorted_accepted_asks),
+                tuple(self.outstanding_bid_prices), tuple(self.outstanding_ask_prices))
+
     def respond(self, time, lob, trade, verbose):
         # what, if anything, has happened on the bid LOB?
         self.outstanding_bids = lob['bids']['lob']
+        self.outstanding_bid_prices = sorted([thing[0] for thing in self.outstanding_bids])
         bid_improved = False
         bid_hit = False
         lob_best_bid_p = lob['bids']['best']
@@ -638,6 +940,8 @@ class Trader_GDX(Trader):
                     (self.prev_best_bid_p == lob_best_bid_p) and (self.prev_best_bid_q > lob_best_bid_q))):
                 # previous best bid was hit
                 self.accepted_bids.append(self.prev_best_bid_p)
+                self.accepted_bid_times.append(time)
+                bisect.insort(self.sorted_accepted_bids, self.prev_best_bid_p)
                 bid_hit = True
         elif self.prev_best_bid_p != None:
             # the bid LOB has been emptied: was it cancelled or hit?
@@ -649,6 +953,7 @@ class Trader_GDX(Trader):
 
         # what, if anything, has happened on the ask LOB?
         self.outstanding_asks = lob['asks']['lob']
+        self.outstanding_ask_prices = sorted([thing[0] for thing in self.outstanding_asks])
         ask_improved = False
         ask_lifted = False
         lob_best_ask_p = lob['asks']['best']
@@ -663,6 +968,8 @@ class Trader_GDX(Trader):
                     (self.prev_best_ask_p == lob_best_ask_p) and (self.prev_best_ask_q > lob_best_ask_q))):
                 # trade happened and best ask price has got worse, or stayed same but quantity reduced -- assume previous best ask was lifted
                 self.accepted_asks.append(self.prev_best_ask_p)
+                self.accepted_ask_times.append(time)
+                bisect.insort(self.sorted_accepted_asks, self.prev_best_ask_p)
                 ask_lifted = True
         elif self.prev_best_ask_p != None:
             # the ask LOB is empty now but was not previously: canceled or lifted?
@@ -672,19 +979,28 @@ class Trader_GDX(Trader):
             else:
                 ask_lifted = True
 
-        # populate expected values
-        if self.first_turn:
+        self.forget(time)
+
+        # populate expected values, on the first respond() after getorder() has given the trader a job
+        # and a limit to value them for (the trader does not quote until then)
+        if self.first_turn and self.job != None:
             #print("populating")
             self.first_turn = False
-            for n in range(1, self.remaining_offer_ops):
-                for m in range(1, self.holdings):
-                    if self.job == 'Bid':
-                        # BUYER
-                        self.values[m][n] = self.calc_p_bid(m, n)
+            key = self.values_key()
+            if self.value_memo != None and key in self.value_memo:
+                self.values = [row[:] for row in self.value_memo[key]]
+            else:
+                for n in range(1, self.remaining_offer_ops):
+                    for m in range(1, self.holdings):
+                        if self.job == 'Bid':
+                            # BUYER
+                            self.values[m][n] = self.calc_p_bid(m, n)
 
-                    if self.job == 'Ask':
-                        # BUYER
-                        self.values[m][n] = self.calc_p_ask(m, n)
+                        if self.job == 'Ask':
+                            # BUYER
+                            self.values[m][n] = self.calc_p_ask(m, n)
+                if self.value_memo != None:
+                    self.value_memo[key] = [row[:] for row in self.values]
             #print("done")
 
         deal = bid_hit or ask_lifted
@@ -695,9 +1011,35 @@ class Trader_GDX(Trader):
         self.prev_best_ask_p = lob_best_ask_p
         self.prev_best_ask_q = lob_best_ask_q
 
+
+trader_registry.register('GDX', Trader_GDX)
+
+
+# which AA implementation populate_market() uses for 'AA' traders: 'borsim' for Trader_AA below, or
+# 'ema' for Ash Booth's version in Trader_AA.py (EMA equilibrium estimate, Newton-Raphson theta)
+aa_engine = 'borsim'
+# with the 'ema' engine, solve the theta estimates of all AA traders in one batched numpy call per
+# market event instead of one Newton-Raphson loop per trader (ignored without numpy)
+aa_batch_newton = False
+# run all ZIP traders of a market as one ZIPPopulation, with their state in numpy arrays
+# and one vectorised respond per market event (ignored without numpy)
+zip_population = False
+# run all Giveaway, ZIC, Shaver and Sniper traders of a market as one StatelessPopulation, which
+# skips their empty respond() calls
+stateless_population = False
+
+
 # Trader subclass AA
 class Trader_AA(Trader):
 
+        __slots__ = ('limit', 'job', 'r_shout_change_relative', 'r_shout_change_absolute',
+                     'short_term_learning_rate', 'long_term_learning_rate', 'moving_average_weight_decay',
+                     'moving_average_window_size', 'offer_change_rate', 'theta', 'theta_max', 'theta_min',
+                     'marketMax', 'trades', 'moving_average_weights', 'estimated_equilibrium',
+                     'smiths_alpha', 'eq_n', 'eq_ref', 'eq_sum', 'eq_sumsq', 'alpha_min', 'alpha_max',
+                     'prev_best_bid_p', 'prev_best_bid_q', 'prev_best_ask_p', 'prev_best_ask_q', 'r_shout',
+                     'buy_target', 'sell_target', 'buy_r', 'sell_r', 'target_dirty', 'target_key', 'active')
+
         def __init__(self, ttype, tid, balance, time):
                 # Stuff about trader
                 self.ttype = ttype
@@ -706,7 +1048,7 @@ class Trader_AA(Trader):
                 self.birthtime = time
                 self.profitpertime = 0
                 self.n_trades = 0
-                self.blotter = []
+                self.blotter = new_blotter()
                 self.orders = []
                 self.n_quotes = 0
                 self.lastquote = None
@@ -717,8 +1059,8 @@ class Trader_AA(Trader):
                 # learning variables
                 self.r_shout_change_relative = 0.05
                 self.r_shout_change_absolute = 0.05
-                self.short_term_learning_rate = random.uniform(0.1, 0.5)
-                self.long_term_learning_rate = random.uniform(0.1, 0.5)
+                self.short_term_learning_rate = rng.uniform(0.1, 0.5)
+                self.long_term_learning_rate = rng.uniform(0.1, 0.5)
                 self.moving_average_weight_decay = 0.95 # how fast weight decays with time, lower is quicker, 0.9 in vytelingum
                 self.moving_average_window_size = 5
                 self.offer_change_rate = 3.0
@@ -728,12 +1070,22 @@ class Trader_AA(Trader):
                 self.marketMax = bse_sys_maxprice
 
                 # Variables to describe the market
-                self.previous_transactions = []
+                # the exchange's trade history (lob['trades']); only the last moving_average_window_size
+                # trades are ever used, see previous_transactions
+                self.trades = None
                 self.moving_average_weights = []
                 for i in range(self.moving_average_window_size):
                         self.moving_average_weights.append(self.moving_average_weight_decay**i)
-                self.estimated_equilibrium = []
-                self.smiths_alpha = []
+                # recent equilibrium estimates and Smith's alphas; the statistics over all of them are kept
+                # as running values below, so a deal costs the same however long the session has been going
+                self.estimated_equilibrium = collections.deque(maxlen=self.moving_average_window_size)
+                self.smiths_alpha = collections.deque(maxlen=self.moving_average_window_size)
+                self.eq_n = 0
+                self.eq_ref = None  # first estimate: the sums are taken relative to it to keep them small
+                self.eq_sum = 0.0  # sum of (estimate - eq_ref)
+                self.eq_sumsq = 0.0  # sum of (estimate - eq_ref)**2
+                self.alpha_min = None
+                self.alpha_max = None
                 self.prev_best_bid_p = None
                 self.prev_best_bid_q = None
                 self.prev_best_ask_p = None
@@ -743,10 +1095,21 @@ class Trader_AA(Trader):
                 self.r_shout = None
                 self.buy_target = None
                 self.sell_target = None
-                self.buy_r = -1.0 * (0.3 * random.random())
-                self.sell_r = -1.0 * (0.3 * random.random())
+                self.buy_r = -1.0 * (0.3 * rng.random())
+                self.sell_r = -1.0 * (0.3 * rng.random())
+                # the targets only change with the customer order or after a deal, so they are
+                # cached: target_key is the (limit, job) they were computed for
+                self.target_dirty = True
+                self.target_key = None
+
 
 
+        # prices of the last moving_average_window_size trades, oldest first
+        @property
+        def previous_transactions(self):
+                if self.trades == None:
+                        return []
+                return self.trades.last(self.moving_average_window_size)
 
         def calcEq(self):
                 # Slightly modified from paper, it is unclear inpaper
@@ -755,27 +1118,41 @@ class Trader_AA(Trader):
                         return
                 elif len(self.previous_transactions) < self.moving_average_window_size:
                         # Not enough transactions
-                        self.estimated_equilibrium.append(float(sum(self.previous_transactions)) / max(len(self.previous_transactions), 1))
+                        self.addEq(float(sum(self.previous_transactions)) / max(len(self.previous_transactions), 1))
                 else:
-                        N_previous_transactions = self.previous_transactions[-self.moving_average_window_size:]
+                        N_previous_transactions = list(self.previous_transactions)
                         thing = [N_previous_transactions[i]*self.moving_average_weights[i] for i in range(self.moving_average_window_size)]
                         eq = sum( thing ) / sum(self.moving_average_weights)
-                        self.estimated_equilibrium.append(eq)
+                        self.addEq(eq)
+
+        def addEq(self, eq):
+                self.estimated_equilibrium.append(eq)
+                if self.eq_ref == None:
+                        self.eq_ref = eq
+                self.eq_n += 1
+                self.eq_sum += eq - self.eq_ref
+                self.eq_sumsq += (eq - self.eq_ref)**2
 
         def calcAlpha(self):
-                alpha = 0.0
-                for p in self.estimated_equilibrium:
-                        alpha += (p - self.estimated_equilibrium[-1])**2
-                alpha = math.sqrt(alpha/len(self.estimated_equilibrium))
-                self.smiths_alpha.append( alpha/self.estimated_equilibrium[-1] )
+                # RMS deviation of all the estimates from the latest one, from the running sums:
+                # sum((p - last)**2) = sumsq - 2 * d * sum + n * d**2, with d = last - eq_ref
+                d = self.estimated_equilibrium[-1] - self.eq_ref
+                alpha = self.eq_sumsq - 2 * d * self.eq_sum + self.eq_n * d**2
+                alpha = math.sqrt(max(alpha, 0.0)/self.eq_n)
+                alpha = alpha/self.estimated_equilibrium[-1]
+                self.smiths_alpha.append(alpha)
+                if self.alpha_min == None or alpha < self.alpha_min:
+                        self.alpha_min = alpha
+                if self.alpha_max == None or alpha > self.alpha_max:
+                        self.alpha_max = alpha
 
         def calcTheta(self):
                 gamma = 2.0 #not sensitive apparently so choose to be whatever
                 # necessary for intialisation, div by 0
-                if min(self.smiths_alpha) == max(self.smiths_alpha):
+                if self.alpha_min == self.alpha_max:
                         alpha_range = 0.4 #starting value i guess
                 else:
-                        alpha_range = (self.smiths_alpha[-1] - min(self.smiths_alpha)) / (max(self.smiths_alpha) - min(self.smiths_alpha))
+                        alpha_range = (self.smiths_alpha[-1] - self.alpha_min) / (self.alpha_max - self.alpha_min)
                 theta_range = self.theta_max - self.theta_min
                 desired_theta = self.theta_min + (theta_range) * (1 - (alpha_range * math.exp(gamma * (alpha_range - 1))))
                 self.theta = self.theta + self.long_term_learning_rate * (desired_theta - self.theta)
@@ -888,6 +1265,14 @@ class Trader_AA(Trader):
                         if self.sell_target < l:
                                 self.sell_target = l
 
+                self.target_dirty = False
+                self.target_key = (self.limit, self.job)
+
+        def add_order(self, order, verbose):
+                # a new customer order invalidates the cached targets
+                self.target_dirty = True
+                return Trader.add_order(self, order, verbose)
+
         def getorder(self, time, countdown, lob):
                 if len(self.orders) < 1:
                         self.active = False
@@ -896,7 +1281,9 @@ class Trader_AA(Trader):
                         self.active = True
                         self.limit = self.orders[0].price
                         self.job = self.orders[0].otype
-                        self.calcTarget()
+                        self.trades = lob['trades']
+                        if self.target_dirty or self.target_key != (self.limit, self.job):
+                                self.calcTarget()
 
                         if self.prev_best_bid_p == None:
                                 o_bid = 0
@@ -942,6 +1329,8 @@ class Trader_AA(Trader):
                 return order
 
         def respond(self, time, lob, trade, verbose):
+            self.trades = lob['trades']
+
             ## Begin nicked from ZIP
 
             # what, if anything, has happened on the bid LOB? Nicked from ZIP..
@@ -999,7 +1388,6 @@ class Trader_AA(Trader):
             ## End nicked from ZIP
 
             if deal:
-                    self.previous_transactions.append(trade['price'])
                     if self.sell_target == None:
                             self.sell_target = trade['price']
                     if self.buy_target == None:
@@ -1012,10 +1400,17 @@ class Trader_AA(Trader):
                     self.calcTarget()
 
 
+trader_registry.register('AA', Trader_AA)
+# Trader_AA.py imports from this module, so its AA is registered by name and imported on first use
+trader_registry.register('AA/ema', 'Trader_AA:Trader_AA')
+
+
 # Trader subclass ZI-C
 # After Gode & Sunder 1993
 class Trader_ZIC(Trader):
 
+    __slots__ = ()
+
     def getorder(self, time, countdown, lob):
         if len(self.orders) < 1:
             # no orders: return NULL
@@ -1027,20 +1422,25 @@ class Trader_ZIC(Trader):
             limit = self.orders[0].price
             otype = self.orders[0].otype
             if otype == 'Bid':
-                quoteprice = random.randint(minprice, limit)
+                quoteprice = rng.randint(minprice, limit)
             else:
-                quoteprice = random.randint(limit, maxprice)
+                quoteprice = rng.randint(limit, maxprice)
                 # NB should check it == 'Ask' and barf if not
             order = Order(self.tid, otype, quoteprice, self.orders[0].qty, time, qid)
             self.lastquote = order
         return order
 
 
+trader_registry.register('ZIC', Trader_ZIC)
+
+
 # Trader subclass Shaver
 # shaves a penny off the best price
 # if there is no best price, creates "stub quote" at system max/min
 class Trader_Shaver(Trader):
 
+    __slots__ = ()
+
     def getorder(self, time, countdown, lob):
         if len(self.orders) < 1:
             order = None
@@ -1066,15 +1466,23 @@ class Trader_Shaver(Trader):
         return order
 
 
+trader_registry.register('SHVR', Trader_Shaver)
+
+
 # Trader subclass Sniper
 # Based on Shaver,
 # "lurks" until time remaining < threshold% of the trading session
 # then gets increasing aggressive, increasing "shave thickness" as time runs out
 class Trader_Sniper(Trader):
 
+    __slots__ = ()
+
+    lurk_threshold = 0.2
+    shavegrowthrate = 3
+
     def getorder(self, time, countdown, lob):
-        lurk_threshold = 0.2
-        shavegrowthrate = 3
+        lurk_threshold = self.lurk_threshold
+        shavegrowthrate = self.shavegrowthrate
         shave = int(1.0 / (0.01 + countdown / (shavegrowthrate * lurk_threshold)))
         if (len(self.orders) < 1) or (countdown > lurk_threshold):
             order = None
@@ -1100,6 +1508,21 @@ class Trader_Sniper(Trader):
             self.lastquote = order
         return order
 
+    # lurks until the last lurk_threshold of the session
+    def wakeup_time(self, starttime, endtime):
+        return endtime - self.lurk_threshold * (endtime - starttime)
+
+
+trader_registry.register('SNPR', Trader_Sniper)
+
+
+# The traders of the strategies that keep no state between market events (Giveaway, ZIC, Shaver,
+# Sniper). Their respond() does nothing, so it is not called at all; they still quote with their own
+# getorder(), which is as cheap as a quote can be made when only one trader quotes per tick.
+class StatelessPopulation(Population):
+
+    replaces_respond = True
+
 
 # Trader subclass ZIP
 # After Cliff 1997
@@ -1110,6 +1533,10 @@ class Trader_ZIP(Trader):
     #    so a single trader can both buy AND sell
     #    -- in the original, traders were either buyers OR sellers
 
+    __slots__ = ('job', 'active', 'prev_change', 'beta', 'momntm', 'ca', 'cr', 'margin', 'margin_buy',
+                 'margin_sell', 'price', 'limit', 'prev_best_bid_p', 'prev_best_bid_q', 'prev_best_ask_p',
+                 'prev_best_ask_q')
+
     def __init__(self, ttype, tid, balance, time):
         self.ttype = ttype
         self.tid = tid
@@ -1117,20 +1544,20 @@ class Trader_ZIP(Trader):
         self.birthtime = time
         self.profitpertime = 0
         self.n_trades = 0
-        self.blotter = []
+        self.blotter = new_blotter()
         self.orders = []
         self.n_quotes = 0
         self.lastquote = None
         self.job = None  # this gets switched to 'Bid' or 'Ask' depending on order-type
         self.active = False  # gets switched to True while actively working an order
         self.prev_change = 0  # this was called last_d in Cliff'97
-        self.beta = 0.1 + 0.4 * random.random()
-        self.momntm = 0.1 * random.random()
+        self.beta = 0.1 + 0.4 * rng.random()
+        self.momntm = 0.1 * rng.random()
         self.ca = 0.05  # self.ca & .cr were hard-coded in '97 but parameterised later
         self.cr = 0.05
         self.margin = None  # this was called profit in Cliff'97
-        self.margin_buy = -1.0 * (0.05 + 0.3 * random.random())
-        self.margin_sell = 0.05 + 0.3 * random.random()
+        self.margin_buy = -1.0 * (0.05 + 0.3 * rng.random())
+        self.margin_sell = 0.05 + 0.3 * rng.random()
         self.price = None
         self.limit = None
         # memory of best price & quantity of best bid and ask, on LOB on previous update
@@ -1167,16 +1594,16 @@ class Trader_ZIP(Trader):
 
         def target_up(price):
             # generate a higher target price by randomly perturbing given price
-            ptrb_abs = self.ca * random.random()  # absolute shift
-            ptrb_rel = price * (1.0 + (self.cr * random.random()))  # relative shift
+            ptrb_abs = self.ca * rng.random()  # absolute shift
+            ptrb_rel = price * (1.0 + (self.cr * rng.random()))  # relative shift
             target = int(round(ptrb_rel + ptrb_abs, 0))
             # #                        print('TargetUp: %d %d\n' % (price,target))
             return (target)
 
         def target_down(price):
             # generate a lower target price by randomly perturbing given price
-            ptrb_abs = self.ca * random.random()  # absolute shift
-            ptrb_rel = price * (1.0 - (self.cr * random.random()))  # relative shift
+            ptrb_abs = self.ca * rng.random()  # absolute shift
+            ptrb_rel = price * (1.0 - (self.cr * rng.random()))  # relative shift
             target = int(round(ptrb_rel - ptrb_abs, 0))
             # #                        print('TargetDn: %d %d\n' % (price,target))
             return (target)
@@ -1312,6 +1739,222 @@ class Trader_ZIP(Trader):
         self.prev_best_ask_q = lob_best_ask_q
 
 
+trader_registry.register('ZIP', Trader_ZIP)
+
+
+# ZIP job codes in ZIPPopulation's arrays
+zip_no_job = 0
+zip_bid = 1
+zip_ask = 2
+
+
+# round() as the scalar ZIP code gets it from Python: half away from zero under Python 2, half to even under Python 3
+def round_like_python(x):
+    if round(0.5) == 1.0:
+        whole = np.trunc(x)
+        return whole + np.where(np.abs(x - whole) >= 0.5, np.sign(x), 0.0)
+    return np.round(x)
+
+
+# A ZIP trader whose state lives in the arrays of a ZIPPopulation, which does all of its responding
+class Trader_ZIPBatched(Trader_ZIP):
+
+    __slots__ = ('population', 'index')
+
+    def __init__(self, ttype, tid, balance, time):
+        Trader_ZIP.__init__(self, ttype, tid, balance, time)
+        self.population = None  # set by ZIPPopulation
+        self.index = None
+
+    def getorder(self, time, countdown, lob):
+        pop = self.population
+        i = self.index
+        if len(self.orders) < 1:
+            pop.active[i] = False
+            order = None
+        else:
+            pop.active[i] = True
+            limit = self.orders[0].price
+            pop.limit[i] = limit
+            if self.orders[0].otype == 'Bid':
+                # currently a buyer (working a bid order)
+                pop.job[i] = zip_bid
+                margin = pop.margin_buy[i]
+            else:
+                # currently a seller (working a sell order)
+                pop.job[i] = zip_ask
+                margin = pop.margin_sell[i]
+            pop.margin[i] = margin
+            quoteprice = int(limit * (1 + margin))
+            pop.price[i] = quoteprice
+
+            order = Order(self.tid, self.orders[0].otype, quoteprice, self.orders[0].qty, time, lob['QID'])
+            self.lastquote = order
+        return order
+
+    def respond(self, time, lob, trade, verbose):
+        return None
+
+
+trader_registry.register('ZIP/population', Trader_ZIPBatched)
+
+
+# The ZIP traders of a market as a struct of arrays: Trader_ZIP.respond() for all of them is done here
+# in one vectorised pass per market event. Every ZIP trader sees the same LOB updates, so the
+# LOB analysis is done once; the random perturbations of the target prices are drawn up front,
+# in the order the traders would have drawn them one by one.
+class ZIPPopulation(Population):
+
+    replaces_respond = True
+
+    def __init__(self, traders):
+        Population.__init__(self, traders)
+        n = len(traders)
+        self.job = np.zeros(n, dtype=int)
+        self.active = np.zeros(n, dtype=bool)
+        self.price = np.zeros(n)
+        self.limit = np.ones(n)
+        self.margin = np.zeros(n)
+        self.margin_buy = np.array([t.margin_buy for t in traders])
+        self.margin_sell = np.array([t.margin_sell for t in traders])
+        self.beta = np.array([t.beta for t in traders])
+        self.momntm = np.array([t.momntm for t in traders])
+        self.prev_change = np.array([float(t.prev_change) for t in traders])
+        self.ca = np.array([t.ca for t in traders])
+        self.cr = np.array([t.cr for t in traders])
+        for i in range(n):
+            traders[i].population = self
+            traders[i].index = i
+        # memory of best price & quantity of best bid and ask, on LOB on previous update
+        self.prev_best_bid_p = None
+        self.prev_best_bid_q = None
+        self.prev_best_ask_p = None
+        self.prev_best_ask_q = None
+
+    # target_up()/target_down() of Trader_ZIP for the traders in mask, perturbing the prices in base
+    def targets(self, targets, up, down, base):
+        draws = up | down
+        n_draws = int(np.count_nonzero(draws))
+        if n_draws == 0:
+            return
+        perturbations = np.array([rng.random() for i in range(2 * n_draws)])
+        ptrb_abs = np.zeros(len(targets))
+        ptrb_rel = np.zeros(len(targets))
+        ptrb_abs[draws] = self.ca[draws] * perturbations[0::2]  # absolute shift
+        ptrb_rel[draws] = self.cr[draws] * perturbations[1::2]  # relative shift
+        targets[up] = round_like_python(base[up] * (1.0 + ptrb_rel[up]) + ptrb_abs[up])
+        targets[down] = round_like_python(base[down] * (1.0 - ptrb_rel[down]) - ptrb_abs[down])
+
+    # profit_alter() of Trader_ZIP for the traders in mask
+    def profit_alter(self, mask, targets):
+        diff = targets[mask] - self.price[mask]
+        change = ((1.0 - self.momntm[mask]) * (self.beta[mask] * diff)) + (self.momntm[mask] * self.prev_change[mask])
+        self.prev_change[mask] = change
+        newmargin = ((self.price[mask] + change) / self.limit[mask]) - 1.0
+
+        buying = self.job[mask] == zip_bid
+        idx = np.flatnonzero(mask)
+        set_buy = idx[buying & (newmargin < 0.0)]
+        set_sell = idx[~buying & (newmargin > 0.0)]
+        newmargin_by_index = np.zeros(len(self.price))
+        newmargin_by_index[idx] = newmargin
+        self.margin_buy[set_buy] = newmargin_by_index[set_buy]
+        self.margin_sell[set_sell] = newmargin_by_index[set_sell]
+        self.margin[set_buy] = newmargin_by_index[set_buy]
+        self.margin[set_sell] = newmargin_by_index[set_sell]
+
+        # set the price from limit and profit-margin
+        self.price[mask] = round_like_python(self.limit[mask] * (1.0 + self.margin[mask]))
+
+    def respond(self, time, lob, trade, verbose):
+        # what, if anything, has happened on the bid LOB?
+        bid_improved = False
+        bid_hit = False
+        lob_best_bid_p = lob['bids']['best']
+        lob_best_bid_q = None
+        if lob_best_bid_p != None:
+            # non-empty bid LOB
+            lob_best_bid_q = lob['bids']['lob'][-1][1]
+            if self.prev_best_bid_p < lob_best_bid_p:
+                bid_improved = True
+            elif trade != None and ((self.prev_best_bid_p > lob_best_bid_p) or (
+                    (self.prev_best_bid_p == lob_best_bid_p) and (self.prev_best_bid_q > lob_best_bid_q))):
+                bid_hit = True
+        elif self.prev_best_bid_p != None:
+            # the bid LOB has been emptied: was it cancelled or hit?
+            bid_hit = lob['tape'][-1]['type'] != 'Cancel'
+
+        # what, if anything, has happened on the ask LOB?
+        ask_improved = False
+        ask_lifted = False
+        lob_best_ask_p = lob['asks']['best']
+        lob_best_ask_q = None
+        if lob_best_ask_p != None:
+            # non-empty ask LOB
+            lob_best_ask_q = lob['asks']['lob'][0][1]
+            if self.prev_best_ask_p > lob_best_ask_p:
+                ask_improved = True
+            elif trade != None and ((self.prev_best_ask_p < lob_best_ask_p) or (
+                    (self.prev_best_ask_p == lob_best_ask_p) and (self.prev_best_ask_q > lob_best_ask_q))):
+                ask_lifted = True
+        elif self.prev_best_ask_p != None:
+            # the ask LOB is empty now but was not previously: canceled or lifted?
+            ask_lifted = lob['tape'][-1]['type'] != 'Cancel'
+
+        deal = bid_hit or ask_lifted
+
+        selling = self.job == zip_ask
+        buying = self.job == zip_bid
+        n = len(self.traders)
+        up = np.zeros(n, dtype=bool)  # target_up() of base
+        down = np.zeros(n, dtype=bool)  # target_down() of base
+        base = np.zeros(n)
+        targets = np.zeros(n)
+        alter = np.zeros(n, dtype=bool)
+        if deal:
+            tradeprice = trade['price']
+            base[:] = tradeprice
+            # sellers that could have sold for more raise their margin; those that wouldn't have got
+            # this deal and are still working an order reduce it (and the other way round for buyers)
+            sell_up = selling & (self.price <= tradeprice)
+            buy_down = buying & (self.price >= tradeprice)
+            up = sell_up
+            down = buy_down
+            if ask_lifted:
+                down = down | (selling & ~sell_up & self.active)
+            if bid_hit:
+                up = up | (buying & ~buy_down & self.active)
+            alter = up | down
+        else:
+            # no deal: sellers aim for a target price higher than best bid, buyers for one lower than best ask
+            if ask_improved:
+                sell_alter = selling & (self.price > lob_best_ask_p)
+                if lob_best_bid_p != None:
+                    up = sell_alter
+                    base[sell_alter] = lob_best_bid_p
+                else:
+                    targets[sell_alter] = lob['asks']['worst']  # stub quote
+                alter = alter | sell_alter
+            if bid_improved:
+                buy_alter = buying & (self.price < lob_best_bid_p)
+                if lob_best_ask_p != None:
+                    down = buy_alter
+                    base[buy_alter] = lob_best_ask_p
+                else:
+                    targets[buy_alter] = lob['bids']['worst']  # stub quote
+                alter = alter | buy_alter
+
+        if alter.any():
+            self.targets(targets, up, down, base)
+            self.profit_alter(alter, targets)
+
+        # remember the best LOB data ready for next response
+        self.prev_best_bid_p = lob_best_bid_p
+        self.prev_best_bid_q = lob_best_bid_q
+        self.prev_best_ask_p = lob_best_ask_p
+        self.prev_best_ask_q = lob_best_ask_q
+
+
 ##########################---trader-types have all been defined now--################
 
 
@@ -1337,50 +1980,57 @@ def trade_stats(expid, traders, dumpfile, time, lob):
             n = 1
         trader_types[ttype] = {'n': n, 'balance_sum': t_balance}
 
-    dumpfile.write('%s, %06d, ' % (expid, time))
     returned_types = []
     returned_avg_balances  = []
+    type_stats = []
     for ttype in sorted(list(trader_types.keys())):
         n = trader_types[ttype]['n']
         s = trader_types[ttype]['balance_sum']
         avg_balance = trader_types[ttype]['balance_sum'] / trader_types[ttype]['n']
         returned_types.append(ttype)
         returned_avg_balances.append(avg_balance)
-        dumpfile.write('%s, %d, %d, %f, ' % (ttype, s, n, s / float(n)))
+        type_stats.append((ttype, s, n))
 
-    if lob['bids']['best'] != None:
-        dumpfile.write('%d, ' % (lob['bids']['best']))
-    else:
-        dumpfile.write('N, ')
-    if lob['asks']['best'] != None:
-        dumpfile.write('%d, ' % (lob['asks']['best']))
+    # a ResultSink buffers the row; anything else gets it written straight away
+    if hasattr(dumpfile, 'write_stats'):
+        dumpfile.write_stats(expid, time, type_stats, lob['bids']['best'], lob['asks']['best'])
     else:
-        dumpfile.write('N, ')
-    dumpfile.write('\n')
+        dumpfile.write(results.csv_row(expid, time, type_stats, lob['bids']['best'], lob['asks']['best']))
     return returned_types, returned_avg_balances
 
 
+# set the parameter values that a trader spec entry gives for its traders, as in ('ZIP', 4, {'beta': 0.2})
+def set_trader_params(trader, params):
+    for name in sorted(params):
+        try:
+            setattr(trader, name, params[name])
+        except AttributeError:
+            sys.exit('FATAL: %s traders have no parameter %s\n' % (trader.ttype, name))
+
+
 # create a bunch of traders from traders_spec
 # returns tuple (n_buyers, n_sellers)
 # optionally shuffles the pack of buyers and the pack of sellers
+# traders_spec entries are (type, number) or (type, number, {parameter: value})
 def populate_market(traders_spec, traders, shuffle, verbose):
+    # GDX traders with the same job, limit and beliefs share their value table
+    gdx_value_memo = {}
+
+    # the registry entry that robot type is built from under the engine settings
+    def trader_key(robottype):
+        if robottype == 'AA' and aa_engine != 'borsim':
+            if 'AA/%s' % aa_engine not in trader_registry:
+                sys.exit('FATAL: don\'t know AA engine %s\n' % aa_engine)
+            return 'AA/%s' % aa_engine
+        elif robottype == 'ZIP' and zip_population and np != None:
+            return 'ZIP/population'
+        return robottype
+
     def trader_type(robottype, name):
-        if robottype == 'GVWY':
-            return Trader_Giveaway('GVWY', name, 0.00, 0)
-        elif robottype == 'AA':
-            return Trader_AA('AA', name, 0.00, 0)
-        elif robottype == 'GDX':
-            return Trader_GDX('GDX', name, 0.00, 0)
-        elif robottype == 'ZIC':
-            return Trader_ZIC('ZIC', name, 0.00, 0)
-        elif robottype == 'SHVR':
-            return Trader_Shaver('SHVR', name, 0.00, 0)
-        elif robottype == 'SNPR':
-            return Trader_Sniper('SNPR', name, 0.00, 0)
-        elif robottype == 'ZIP':
-            return Trader_ZIP('ZIP', name, 0.00, 0)
-        else:
-            sys.exit('FATAL: don\'t know robot type %s\n' % robottype)
+        trader = trader_registry.lookup(trader_key(robottype))(robottype, name, 0.00, 0)
+        if isinstance(trader, Trader_GDX):
+            trader.value_memo = gdx_value_memo
+        return trader
 
     def shuffle_traders(ttype_char, n, traders):
         for swap in range(n):
@@ -1397,9 +2047,13 @@ def populate_market(traders_spec, traders, shuffle, verbose):
     n_buyers = 0
     for bs in traders_spec['buyers']:
         ttype = bs[0]
+        params = {}
+        if len(bs) > 2:
+            params = bs[2]
         for b in range(bs[1]):
             tname = 'B%02d' % n_buyers  # buyer i.d. string
             traders[tname] = trader_type(ttype, tname)
+            set_trader_params(traders[tname], params)
             n_buyers = n_buyers + 1
 
     if n_buyers < 1:
@@ -1410,9 +2064,13 @@ def populate_market(traders_spec, traders, shuffle, verbose):
     n_sellers = 0
     for ss in traders_spec['sellers']:
         ttype = ss[0]
+        params = {}
+        if len(ss) > 2:
+            params = ss[2]
         for s in range(ss[1]):
             tname = 'S%02d' % n_sellers  # buyer i.d. string
             traders[tname] = trader_type(ttype, tname)
+            set_trader_params(traders[tname], params)
             n_sellers = n_sellers + 1
 
     if n_sellers < 1:
@@ -1420,6 +2078,22 @@ def populate_market(traders_spec, traders, shuffle, verbose):
 
     if shuffle: shuffle_traders('S', n_sellers, traders)
 
+    populations = []
+    if aa_engine == 'ema' and aa_batch_newton and np != None:
+        import Trader_AA as aa_ema
+        aa_traders = [traders[tname] for tname in sorted(traders) if traders[tname].ttype == 'AA']
+        if len(aa_traders) > 0:
+            populations.append(aa_ema.AAPopulation(aa_traders))
+    # in the order market_session() goes through the traders, so the ZIP random draws happen in the same order
+    zip_traders = [traders[tname] for tname in traders if isinstance(traders[tname], Trader_ZIPBatched)]
+    if len(zip_traders) > 0:
+        populations.append(ZIPPopulation(zip_traders))
+    if stateless_population:
+        stateless_types = (Trader_Giveaway, Trader_ZIC, Trader_Shaver, Trader_Sniper)
+        stateless_traders = [traders[tname] for tname in sorted(traders) if type(traders[tname]) in stateless_types]
+        if len(stateless_traders) > 0:
+            populations.append(StatelessPopulation(stateless_traders))
+
     if verbose:
         for t in range(n_buyers):
             bname = 'B%02d' % t
@@ -1428,7 +2102,7 @@ def populate_market(traders_spec, traders, shuffle, verbose):
             bname = 'S%02d' % t
             print(traders[bname])
 
-    return {'n_buyers': n_buyers, 'n_sellers': n_sellers}
+    return {'n_buyers': n_buyers, 'n_sellers': n_sellers, 'populations': populations}
 
 
 # customer_orders(): allocate orders to traders
@@ -1620,15 +2294,61 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
     return [new_pending, cancellations]
 
 
+# leave traders out of the random choice of who quotes next until their wakeup_time(), instead of
+# spending ticks on asking them for quotes they cannot give (changes which traders get which ticks);
+# set from the sweep's "schedule_wakeups"
+schedule_wakeups = False
+
+# market_session() writes the tape of every session to this file, overwriting the last one; None for no dump
+tape_fname = 'transactions.csv'
+
+
 # one session in the market
-def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dumpfile, dump_each_trade, verbose):
+# quotes and trades are checked by validator, which collects the violations of every session it is
+# handed; without one, the session makes its own from the validation_ settings
+def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dumpfile, dump_each_trade, verbose,
+                   validator=None):
     # initialise the exchange
     exchange = Exchange()
 
+    if validator == None:
+        validator = validation.Validator(validation_mode, validation_sample_every, validation_fatal)
+    validator.start_session(sess_id)
+
+    # the strategies' random numbers for this session
+    global rng
+    if random_blocks and np != None:
+        rng = RandomStream(random.getrandbits(32), random_block_size)
+    else:
+        rng = random
+
     # create a bunch of traders
     traders = {}
     trader_stats = populate_market(trader_spec, traders, True, verbose)
 
+    # traders whose whole respond() is done by their population are left out of the per-trader loop
+    batched = set()
+    for population in trader_stats['populations']:
+        if population.replaces_respond:
+            batched.update([t.tid for t in population.traders])
+    responders = [t for t in traders if t not in batched]
+    # traders whose quotes come from their population's getorder(): tid -> (population, index)
+    quoters = {}
+    for population in trader_stats['populations']:
+        if population.replaces_getorder:
+            for index in range(len(population.traders)):
+                quoters[population.traders[index].tid] = (population, index)
+
+    # the traders that can be picked to quote; with schedule_wakeups, the sleeping ones join at their wakeup time
+    tids = list(traders.keys())
+    sleepers = []
+    if schedule_wakeups:
+        wakeups = dict([(t, traders[t].wakeup_time(starttime, endtime)) for t in tids])
+        sleepers = sorted([wakeups[t] for t in tids if wakeups[t] > starttime])
+        awake = [t for t in tids if wakeups[t] <= starttime]
+    else:
+        awake = tids
+
     # timestep set so that can process all traders in one second
     # NB minimum interarrival time of customer orders may be much less than this!!
     timestep = 1.0 / float(trader_stats['n_buyers'] + trader_stats['n_sellers'])
@@ -1671,40 +2391,61 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
                     # if verbose : print('Killing order %s' % (str(traders[kill].lastquote)))
                     exchange.del_order(time, traders[kill].lastquote, verbose)
 
+        if len(sleepers) > 0 and sleepers[0] <= time:
+            # keeping the order of tids, so the choice below only depends on who is awake
+            awake = [t for t in tids if wakeups[t] <= time]
+            sleepers = [wakeup for wakeup in sleepers if wakeup > time]
+        if len(awake) == 0:
+            time = time + timestep
+            continue
+
         # get a limit-order quote (or None) from a randomly chosen trader
-        tid = list(traders.keys())[random.randint(0, len(traders) - 1)]
-        order = traders[tid].getorder(time, time_left, exchange.publish_lob(time, lob_verbose))
+        tid = awake[random.randint(0, len(awake) - 1)]
+        if tid in quoters:
+            (population, index) = quoters[tid]
+            order = population.getorder(index, time, time_left, exchange.publish_lob(time, lob_verbose))
+        else:
+            order = traders[tid].getorder(time, time_left, exchange.publish_lob(time, lob_verbose))
 
         # if verbose: print('Trader Quote: %s' % (order))
 
         if order != None:
-            if order.otype == 'Ask' and order.price < traders[tid].orders[0].price: sys.exit('Bad ask')
-            if order.otype == 'Bid' and order.price > traders[tid].orders[0].price: sys.exit('Bad bid')
+            # the price is put on the exchange's grid first, so the check sees the price that reaches the book
+            exchange.quantise(order)
+            if not validator.check_quote(time, traders[tid], order):
+                # the quote is reported and not sent to the exchange
+                order = None
+
+        if order != None:
             # send order to exchange
             traders[tid].n_quotes = 1
             trade = exchange.process_order2(time, order, process_verbose)
             if trade != None:
                 # trade occurred,
                 # so the counterparties update order lists and blotters
-                traders[trade['party1']].bookkeep(trade, order, bookkeep_verbose, time)
-                traders[trade['party2']].bookkeep(trade, order, bookkeep_verbose, time)
-                if dump_each_trade: trade_stats(sess_id, traders, tdump, time, exchange.publish_lob(time, lob_verbose))
+                for party in (trade['party1'], trade['party2']):
+                    validator.check_trade(time, traders[party], trade['price'])
+                    traders[party].bookkeep(trade, order, bookkeep_verbose, time)
+                if dump_each_trade: trade_stats(sess_id, traders, dumpfile, time, exchange.publish_lob(time, lob_verbose))
 
             # traders respond to whatever happened
             lob = exchange.publish_lob(time, lob_verbose)
-            for t in traders:
+            for t in responders:
                 # NB respond just updates trader's internal variables
                 # doesn't alter the LOB, so processing each trader in
                 # sequence (rather than random/shuffle) isn't a problem
                 traders[t].respond(time, lob, trade, respond_verbose)
+            for population in trader_stats['populations']:
+                population.respond(time, lob, trade, respond_verbose)
 
         time = time + timestep
 
     # end of an experiment -- dump the tape
-    exchange.tape_dump('transactions.csv', 'w', 'keep')
+    if tape_fname != None:
+        exchange.tape_dump(tape_fname, 'w', 'keep')
 
     # write trade_stats for this experiment NB end-of-session summary only
-    type_list, avg_balance_list = trade_stats(sess_id, traders, tdump, time, exchange.publish_lob(time, lob_verbose))
+    type_list, avg_balance_list = trade_stats(sess_id, traders, dumpfile, time, exchange.publish_lob(time, lob_verbose))
     return type_list, avg_balance_list
 
 def random_order_schedule(duration=330, interval=30, midprice=100,
@@ -1714,19 +2455,22 @@ def random_order_schedule(duration=330, interval=30, midprice=100,
     if (max_num_schedules > duration/interval):
         print("Maximum number of schedules too high. Generated empty schedule.")
         return {}
+    # a seeded schedule is drawn from a generator of its own, so the market's random numbers are left
+    # alone (random.seed(seed) followed by the same draws would give the same schedule)
+    sched_random = random
     if seeded:
-        random.seed(a=seed)
+        sched_random = random.Random(seed)
 
-    timemode  = switch_timemode(random.randrange(max_timemode))
+    timemode  = switch_timemode(sched_random.randrange(max_timemode))
     num_sched = 1
     if max_num_schedules != 1:
-        num_sched = random.randrange(0, max_num_schedules) + 1
+        num_sched = sched_random.randrange(0, max_num_schedules) + 1
     num_ext_i = (duration/interval) - num_sched
     sched_dur = []
     for i in range(0, num_sched):
         sched_dur.append(1)
     for i in range(0, num_ext_i):
-        extended_duration_ind = random.randrange(num_sched) - 1
+        extended_duration_ind = sched_random.randrange(num_sched) - 1
         sched_dur[extended_duration_ind] += 1
 
     start_time = 0
@@ -1735,33 +2479,33 @@ def random_order_schedule(duration=330, interval=30, midprice=100,
     dem_sched  = []
     for i in range(0, num_sched):
 
-        current_vol                 = random.randrange(max_volatility) 
+        current_vol                 = sched_random.randrange(max_volatility) 
         current_midpoint_change     = 0
         if max_midprice_change != 0:
-            current_midpoint_change = random.randrange(max_midprice_change)
+            current_midpoint_change = sched_random.randrange(max_midprice_change)
         if max_volatility <= current_midpoint_change:
             max_volatility = current_midpoint_change + 1
-        current_midpoint_direction  = random.randrange(-1, 2, 2)
+        current_midpoint_direction  = sched_random.randrange(-1, 2, 2)
         current_midpoint            = midprice + (current_midpoint_direction * current_midpoint_change)
         sup_start                   = current_midpoint - current_vol
         sup_end                     = current_midpoint + current_vol
         sup_range                   = (sup_start, sup_end)
-        current_stepmode            = switch_stepmode(random.randrange(max_stepmode))
+        current_stepmode            = switch_stepmode(sched_random.randrange(max_stepmode))
         supp_sched.append({'from': start_time, 'to': end_time, 'ranges': [sup_range], 'stepmode': current_stepmode})
 
-        current_vol                 = random.randrange(max_volatility) 
+        current_vol                 = sched_random.randrange(max_volatility) 
         current_midpoint_change     = 0
         if max_midprice_change != 0:
-            current_midpoint_change = random.randrange(max_midprice_change)
+            current_midpoint_change = sched_random.randrange(max_midprice_change)
         if max_volatility <= current_midpoint_change:
             max_volatility = current_midpoint_change + 1
-        current_midpoint_direction  = random.randrange(-1, 2, 2)
+        current_midpoint_direction  = sched_random.randrange(-1, 2, 2)
         current_midpoint            = midprice + (current_midpoint_direction * current_midpoint_change)
         dem_start                   = current_midpoint - current_vol
         dem_end                     = current_midpoint + current_vol
         dem_range                   = (dem_start, dem_end)
-        current_stepmode            = switch_stepmode(random.randrange(max_stepmode))
-        current_timemode            = switch_timemode(random.randrange(max_timemode))
+        current_stepmode            = switch_stepmode(sched_random.randrange(max_stepmode))
+        current_timemode            = switch_timemode(sched_random.randrange(max_timemode))
         dem_sched.append({'from': start_time, 'to': end_time, 'ranges': [dem_range], 'stepmode': current_stepmode})
         
         
@@ -1829,6 +2573,132 @@ def buyorsell_spec_noise(original_spec, noise_prob):
     noisy_spec = zip(orig_types, new_nums)
     return noisy_spec
 
+# Exact counterpart of buyorsell_spec_noise: each trader independently keeps its type with probability
+# 1 - noise_prob or is mistaken for one of the other types equiprobably, so the noisy spec is a sum of
+# multinomials. Returns every distinct noisy spec together with its probability, as (spec, prob) pairs
+def spec_noise_distribution(original_spec, noise_prob):
+    orig_types = [ttype for (ttype, n) in original_spec]
+    orig_nums  = [n for (ttype, n) in original_spec]
+    num_types  = len(orig_types)
+    # buyorsell_spec_noise compares a uniform draw against noise_prob, so clip it to a probability
+    switch_prob = min(max(float(noise_prob), 0.0), 1.0)
+    if num_types < 2:
+        switch_prob = 0.0
+    keep_prob = 1.0 - switch_prob
+    other_prob = switch_prob / max(num_types - 1, 1)
+
+    distribution = {tuple([0] * num_types): 1.0}
+    for type_index in range(0, num_types):
+        for trader_num in range(0, orig_nums[type_index]):
+            # fold one more trader into the distribution of counts
+            new_distribution = {}
+            for counts in distribution:
+                for new_index in range(0, num_types):
+                    if new_index == type_index:
+                        p = keep_prob
+                    else:
+                        p = other_prob
+                    if p == 0:
+                        continue
+                    new_counts = list(counts)
+                    new_counts[new_index] += 1
+                    new_counts = tuple(new_counts)
+                    new_distribution[new_counts] = new_distribution.get(new_counts, 0.0) + distribution[counts] * p
+            distribution = new_distribution
+
+    return [(list(zip(orig_types, counts)), distribution[counts]) for counts in sorted(distribution)]
+
+# Gives back the spec with one more trader of the given type, used for the enhanced sessions
+def add_trader_to_spec(spec, ttype):
+    return [(t, n + 1) if t == ttype else (t, n) for (t, n) in spec]
+
+# Runs the enhanced sessions: the ratio under test plus one extra trader of the predicted type.
+# Returns the per-type sums of average balances over the sessions and the number of sessions run
+def run_enhanced_trials(ratio_spec, predicted_type, start_time, end_time, order_sched, dumpfile, trialnumber,
+                        n_trials, validator=None):
+    enhanced_spec = add_trader_to_spec(ratio_spec, predicted_type)
+    traders_spec = {'sellers': enhanced_spec, 'buyers': enhanced_spec}
+    balance_sums = {}
+    trial = 0
+    while trial < n_trials:
+        trial_id = 'trial%07d-enhanced' % (trialnumber + trial)
+        type_list, trial_avg_balances = market_session(trial_id, start_time, end_time, traders_spec,
+                                                       order_sched, dumpfile, False, False, validator)
+        for ttype in type_list:
+            balance_sums[ttype] = balance_sums.get(ttype, 0.0) + trial_avg_balances[type_list.index(ttype)]
+        trial = trial + 1
+    return balance_sums, n_trials
+
+# Upper-tail quantile of the standard normal distribution, found by bisection on erfc
+# (no scipy here); used for the confidence radius when racing trader types
+def normal_quantile(tail_prob):
+    lo = 0.0
+    hi = 40.0
+    for i in range(100):
+        mid = (lo + hi) / 2.0
+        if 0.5 * math.erfc(mid / math.sqrt(2.0)) > tail_prob:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+# Races the trader types of a (noisy) spec against each other to find the one with the best average profit.
+# Rather than a fixed number of base sessions, runs sessions until every other type has been eliminated:
+# a type is out once the leader's mean per-session lead over it is positive with the given confidence.
+# Both types are measured in the same sessions, so the test is on the paired per-session differences.
+# The confidence is split over all comparisons and all looks (Bonferroni), so early stopping stays valid.
+# Returns the best type, the number of base sessions used, and the per-type balance sums (like the old accumulator)
+def predict_best_type(traders_spec, start_time, end_time, order_sched, dumpfile, trialnumber,
+                      confidence=0.95, min_sessions=5, max_sessions=50, verbose=False, validator=None):
+    type_order = [ttype for (ttype, n) in traders_spec['buyers'] if n > 0]
+    surviving = list(type_order)
+    balances = {}
+    for ttype in type_order:
+        balances[ttype] = []
+
+    n_comparisons = max(len(type_order) - 1, 1)
+    z = normal_quantile((1.0 - confidence) / (n_comparisons * max_sessions))
+
+    n_sessions = 0
+    while len(surviving) > 1 and n_sessions < max_sessions:
+        trial_id = 'trial%07d-base' % (trialnumber + n_sessions)
+        type_list, trial_avg_balances = market_session(trial_id, start_time, end_time, traders_spec,
+                                                       order_sched, dumpfile, False, False, validator)
+        for ttype in type_list:
+            balances[ttype].append(trial_avg_balances[type_list.index(ttype)])
+        n_sessions = n_sessions + 1
+
+        if n_sessions >= max(min_sessions, 2):
+            leader = surviving[0]
+            for ttype in surviving:
+                if sum(balances[ttype]) > sum(balances[leader]):
+                    leader = ttype
+            still_in = []
+            for ttype in surviving:
+                if ttype == leader:
+                    still_in.append(ttype)
+                    continue
+                diffs = [balances[leader][i] - balances[ttype][i] for i in range(n_sessions)]
+                mean_diff = sum(diffs) / float(n_sessions)
+                var_diff = sum([(d - mean_diff) ** 2 for d in diffs]) / float(n_sessions - 1)
+                radius = z * math.sqrt(var_diff / n_sessions)
+                if mean_diff - radius <= 0:
+                    still_in.append(ttype)
+                elif verbose:
+                    print('%s eliminated by %s after %d sessions' % (ttype, leader, n_sessions))
+            surviving = still_in
+
+    # Average the balances to determine the best trader type for the scenario
+    balance_sums = {}
+    best_predicted_type = ''
+    max_predicted_profit = -99999
+    for ttype in type_order:
+        balance_sums[ttype] = sum(balances[ttype])
+        if ttype in surviving and balance_sums[ttype] > max_predicted_profit:
+            best_predicted_type = ttype
+            max_predicted_profit = balance_sums[ttype]
+    return best_predicted_type, n_sessions, balance_sums
+
 #############################
 
 # # Below here is where we set up and run a series of experiments
@@ -1836,114 +2706,164 @@ def buyorsell_spec_noise(original_spec, noise_prob):
 
 if __name__ == "__main__":
 
+    # the sweep (trader types, population size, noise grid, trials, schedule) comes from a definition file,
+    # optionally followed by a shard index and shard count, e.g. python borsim.py sweeps/borsim.json 0 4
+    sweep_fname, shard_index, n_shards = sweep.sweep_args(sys.argv, 'sweeps/borsim.json')
+    sweep_def = sweep.load_sweep(sweep_fname)
+
     # set up parameters for the session
 
-    start_time = 0.0
-    end_time = 330.0
+    start_time = sweep_def['start_time']
+    end_time = sweep_def['end_time']
     duration = end_time - start_time
 
-
-
-    fname = 'random_order_schedule.csv'
-    # run a sequence of trials that exhaustively varies the ratio of three trader types
+    fname = sweep.shard_fname(sweep_def['results'], shard_index, n_shards)
+    price_quantiser = quantiser.from_setting(sweep_def['price_quantiser'], ticksize, bse_sys_minprice, bse_sys_maxprice)
+    # one validator for the whole run, so the violations of every session end up in one file
+    validator = validation.Validator(sweep_def['validation'], validation_sample_every, validation_fatal)
+    gdx_memory = sweep_def['gdx_memory']
+    gdx_memory_window = sweep_def['gdx_memory_window']
+    gdx_memory_horizon = sweep_def['gdx_memory_horizon']
+    blotter_mode = sweep_def['blotter_mode']
+    blotter_window = sweep_def['blotter_window']
+    random_blocks = sweep_def['random_blocks']
+    random_block_size = sweep_def['random_block_size']
+    schedule_wakeups = sweep_def['schedule_wakeups']
+    # run a sequence of trials that exhaustively varies the ratio of the trader types
     # NB this has weakness of symmetric proportions on buyers/sellers -- combinatorics of varying that are quite nasty
 
-    
-    min_prob = 0
-    max_prob_plus_one_step = 70 
-    num_noise_probability_steps = 14
-    n_trader_types = 3
-    equal_ratio_n = 4
-    n_trials_per_ratio = 50
-    n_traders = n_trader_types * equal_ratio_n
-
-    tdump = open(fname, 'w', 1)
-    tdump.write('%s, %s, ' % ('expid', 'time'))
-    for f in range(3):
-        tdump.write('%s, %s, %s, %s, ' % ('type', 'balance', 'number of traders', 'profit per trader'))
-    tdump.write('\n');
-
-    trialnumber = 1
-    order_sched = random_order_schedule(duration=330, interval=30, midprice=100, max_num_schedules=8, max_volatility=30, max_midprice_change=10, max_stepmode=3, max_timemode=4)
-    for noise_step in range(0, num_noise_probability_steps):
-        
-       
-        min_n = 1
-        trdr_1_n = min_n
-        while trdr_1_n <= n_traders:
-            trdr_2_n = min_n
-            while trdr_2_n <= n_traders - trdr_1_n:
-                trdr_3_n = n_traders - (trdr_1_n + trdr_2_n)
-                if trdr_3_n >= min_n:
-                    buyers_spec = [('AA', trdr_1_n), ('GDX', trdr_2_n),
-                                   ('ZIP', trdr_3_n)]
-                    sellers_spec = buyers_spec
-                    traders_spec = {'sellers': sellers_spec, 'buyers': buyers_spec}
-                    noisy_input_spec  = [('AA', trdr_1_n), ('GDX', trdr_2_n),
-                                   ('ZIP', trdr_3_n)]
-                    # Determine the noisy prediction's schedule
-                    # Noise scales from 0 to 66% - all combinations tested per probability step
-                    # N.b. 66% mistake chance is 100% noise - equal to 3 sided coinflip
-                    #noise_probability = (0.66 / num_noise_probability_steps) * noise_step
-                    noise_probability = min_prob + (((max_prob_plus_one_step - min_prob) / num_noise_probability_steps) * noise_step)
-                    noisy_buyer_spec  = buyorsell_spec_noise(noisy_input_spec, noise_probability)
-                    noisy_seller_spec = noisy_buyer_spec
-                    noisy_traders_spec = {'sellers': noisy_seller_spec, 'buyers': noisy_buyer_spec}
-
-                    type_list = []
-                    trial_avg_balances = []
-                    avg_balance_accumulator = {}
-
-                    # Perform a number of predictions with the noisy ratio
-                    trial = 1
-                    while trial <= n_trials_per_ratio:
-                        trial_id = 'trial%07d-base' % trialnumber
-                        type_list, trial_avg_balances = market_session(trial_id, start_time, end_time, noisy_traders_spec,
-                                                                       order_sched, tdump, False, False)
-                        tdump.flush()
-                        for ttype in type_list:
-                            if ttype not in avg_balance_accumulator:
-                                avg_balance_accumulator[ttype] = 0
-                            avg_balance_accumulator[ttype] += trial_avg_balances[type_list.index(ttype)]
-                        trial = trial + 1
-                        trialnumber = trialnumber + 1
-                        print("Probability ", noise_probability, ", base trial ", trialnumber)
-                    # Average the balances to determine the best trader type for the scenario
-                    best_predicted_type = ''
-                    max_predicted_profit = -99999
-                    for ttype in avg_balance_accumulator.keys():
-                        if avg_balance_accumulator[ttype] > max_predicted_profit:
-                            best_predicted_type = ttype
-                            max_predicted_profit = avg_balance_accumulator[ttype]
-
-                    # Perform a number of trials for the actual experiment with the new type added in as an extra trader
-                    trial = 1
-                    while trial <= n_trials_per_ratio:
-                        trial_id = 'trial%07d-enhanced' % trialnumber
-                        temp_buyers_spec = {}
-                        temp_sellers_spec = {}
-                        temp_traders_spec = {}
-                        if best_predicted_type == 'AA':
-                            temp_buyers_spec = [('AA', trdr_1_n + 1), ('GDX', trdr_2_n),
-                                           ('ZIP', trdr_3_n)]
-                        elif best_predicted_type == 'GDX':
-                            temp_buyers_spec = [('AA', trdr_1_n), ('GDX', trdr_2_n + 1),
-                                           ('ZIP', trdr_3_n)]
-                        elif best_predicted_type == 'ZIP':
-                            temp_buyers_spec = [('AA', trdr_1_n), ('GDX', trdr_2_n),
-                                           ('ZIP', trdr_3_n + 1)]
-                        temp_sellers_spec = temp_buyers_spec
-                        temp_traders_spec = {'sellers': temp_sellers_spec, 'buyers': temp_buyers_spec}
-                        market_session(trial_id, start_time, end_time, temp_traders_spec,
-                                       order_sched, tdump, False, False)
-                        tdump.flush()
-
-                        trial = trial + 1
-                        trialnumber = trialnumber + 1
-                        print("Probability ", noise_probability, ", enhanced trial ", trialnumber)
-                trdr_2_n += 1
-            trdr_1_n += 1
-            
+    trader_types = sweep_def['trader_types']
+    n_trials_per_ratio = sweep_def['n_trials']
+    # best_predicted_type is found by racing the types: base sessions stop once the
+    # leader is ahead of every other type with this confidence (or after n_trials_per_ratio)
+    predict_confidence = 0.95
+    min_predict_trials = 5
+    # exact_noise enumerates the distinct noisy specs with their probabilities instead of drawing one,
+    # and weights the outcomes; noisy specs below min_spec_prob are skipped
+    exact_noise = sweep_def['exact_noise']
+    min_spec_prob = 0.001
+    exact_fname = sweep.shard_fname('exact_noise_outcomes.csv', shard_index, n_shards)
+
+    # session rows are buffered and written in chunks; each finished configuration is a crash-safe checkpoint
+    # running statistics per (stage, noise probability, ratio, type) go to a summary file at every checkpoint
+    aggregator = results.StreamingAggregator(results.summary_fname(fname))
+    tdump = results.ResultSink(fname, trader_types, sweep_def['results_format'], aggregator=aggregator)
+
+    if exact_noise:
+        prediction_cache = {}  # noisy spec -> best predicted type
+        enhanced_cache = {}  # (ratio, predicted type) -> average balance of each type in the enhanced sessions
+        edump = open(exact_fname, 'w')
+        edump.write('%s, ' % 'noise probability')
+        for ttype in trader_types:
+            edump.write('%s, ' % ('number of ' + ttype))
+        for ttype in trader_types:
+            edump.write('%s, ' % ('P(predict ' + ttype + ')'))
+        for ttype in trader_types:
+            edump.write('%s, ' % ('expected profit per ' + ttype))
+        edump.write('\n')
+
+    # trial ids only depend on the configuration, so shards never write the same ids:
+    # every configuration numbers its sessions from its own block of trials_per_config
+    trials_per_config = 2 * n_trials_per_ratio
+    if exact_noise:
+        n_noisy_specs = len(list(sweep.simplex_compositions(sweep_def['n_traders'], len(trader_types), 0)))
+        trials_per_config = (n_noisy_specs + len(trader_types)) * n_trials_per_ratio
+    schedule_source = sweep_def['schedule']
+    if schedule_source['source'] == 'random':
+        # every shard draws the schedule for itself, so they only see the same one if it is seeded
+        if n_shards > 1 and not schedule_source['params'].get('seeded', False):
+            sys.exit('FATAL: a sharded sweep needs "seeded" and "seed" in its random schedule params')
+        order_sched = random_order_schedule(**schedule_source['params'])
+    elif schedule_source['source'] == 'file':
+        order_sched = sweep.load_schedule(schedule_source['path'])
+    else:
+        sys.exit('FATAL: borsim needs a random or file schedule, not %s' % schedule_source['source'])
+
+    # Noise scales from 0 to 66% - all combinations tested per probability step
+    # N.b. 66% mistake chance is 100% noise - equal to 3 sided coinflip
+    for config in sweep.select(sweep.sweep_configurations(sweep_def), shard_index, n_shards):
+        buyers_spec = config['spec']
+        noisy_input_spec = config['spec']
+        # Determine the noisy prediction's schedule
+        noise_probability = config['noise_probability']
+        trialnumber = config['index'] * trials_per_config + 1
+        tdump.context = (noise_probability, config['ratio'])
+        if exact_noise:
+            # Weight the predictions of every distinct noisy spec by its probability;
+            # predictions and enhanced sessions are cached, so they are shared across noise steps
+            predicted_probs = {}
+            for (noisy_buyer_spec, spec_prob) in spec_noise_distribution(noisy_input_spec, noise_probability):
+                if spec_prob < min_spec_prob:
+                    continue
+                spec_key = tuple(noisy_buyer_spec)
+                if spec_key not in prediction_cache:
+                    noisy_traders_spec = {'sellers': noisy_buyer_spec, 'buyers': noisy_buyer_spec}
+                    # cached sessions serve every noise step and ratio that reaches this spec,
+                    # so the summary counts them once, under 'shared' and the ratio they ran on
+                    tdump.context = ('shared', tuple([n for (ttype, n) in noisy_buyer_spec]))
+                    best_predicted_type, n_base_trials, avg_balance_accumulator = predict_best_type(
+                        noisy_traders_spec, start_time, end_time, order_sched, tdump, trialnumber,
+                        predict_confidence, min_predict_trials, n_trials_per_ratio, validator=validator)
+                    trialnumber = trialnumber + n_base_trials
+                    prediction_cache[spec_key] = best_predicted_type
+                    print("Noisy spec ", noisy_buyer_spec, ", base trials used ", n_base_trials,
+                          ", predicted ", best_predicted_type)
+                best_predicted_type = prediction_cache[spec_key]
+                predicted_probs[best_predicted_type] = predicted_probs.get(best_predicted_type, 0.0) + spec_prob
+
+            covered_prob = sum(predicted_probs.values())
+            expected_balances = {}
+            for best_predicted_type in sorted(predicted_probs):
+                enhanced_key = (tuple(buyers_spec), best_predicted_type)
+                if enhanced_key not in enhanced_cache:
+                    tdump.context = ('shared', config['ratio'])
+                    balance_sums, n_enhanced_trials = run_enhanced_trials(
+                        buyers_spec, best_predicted_type, start_time, end_time, order_sched, tdump,
+                        trialnumber, n_trials_per_ratio, validator)
+                    trialnumber = trialnumber + n_enhanced_trials
+                    enhanced_cache[enhanced_key] = dict([(ttype, balance_sums[ttype] / float(n_enhanced_trials))
+                                                         for ttype in balance_sums])
+                weight = predicted_probs[best_predicted_type] / covered_prob
+                for ttype in enhanced_cache[enhanced_key]:
+                    expected_balances[ttype] = expected_balances.get(ttype, 0.0) + \
+                                               weight * enhanced_cache[enhanced_key][ttype]
+
+            edump.write('%s, ' % noise_probability)
+            for (ttype, n) in buyers_spec:
+                edump.write('%d, ' % n)
+            for (ttype, n) in buyers_spec:
+                edump.write('%f, ' % (predicted_probs.get(ttype, 0.0) / covered_prob))
+            for (ttype, n) in buyers_spec:
+                edump.write('%f, ' % expected_balances.get(ttype, 0.0))
+            edump.write('\n')
+            print("Probability ", noise_probability, ", ratio ", buyers_spec, ", predicted ", predicted_probs)
+        else:
+            noisy_buyer_spec  = buyorsell_spec_noise(noisy_input_spec, noise_probability)
+            noisy_seller_spec = noisy_buyer_spec
+            noisy_traders_spec = {'sellers': noisy_seller_spec, 'buyers': noisy_buyer_spec}
+
+            # Race the trader types on the noisy ratio until the best one is known with enough confidence
+            best_predicted_type, n_base_trials, avg_balance_accumulator = predict_best_type(
+                noisy_traders_spec, start_time, end_time, order_sched, tdump, trialnumber,
+                predict_confidence, min_predict_trials, n_trials_per_ratio, validator=validator)
+            trialnumber = trialnumber + n_base_trials
+            print("Probability ", noise_probability, ", base trials used ", n_base_trials,
+                  ", predicted ", best_predicted_type)
+
+            # Perform a number of trials for the actual experiment with the new type added in as an extra trader
+            balance_sums, n_enhanced_trials = run_enhanced_trials(
+                buyers_spec, best_predicted_type, start_time, end_time, order_sched, tdump,
+                trialnumber, n_trials_per_ratio, validator)
+            trialnumber = trialnumber + n_enhanced_trials
+            print("Probability ", noise_probability, ", enhanced trials ", n_enhanced_trials)
+        tdump.checkpoint()
+
     tdump.close()
+    if exact_noise:
+        edump.close()
+    if len(validator.violations) > 0:
+        violations_fname = sweep.shard_fname('profit_violations.csv', shard_index, n_shards)
+        validator.write(violations_fname)
+        print('%d profit-invariant violations, written to %s' % (len(validator.violations), violations_fname))
 
 
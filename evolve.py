@@ -0,0 +1,235 @@
+'''
+Genetic optimisation of the parameters of one trader type of borsim.py.
+
+A candidate is a dict of parameter values for the evolved type (see param_spaces). Its fitness is
+the mean profit per trader of that type over a fixed set of seeded market sessions against the
+other trader types of a sweep, so every candidate meets the same markets. The sessions of a
+generation are run in parallel over a process pool that is kept for the whole run.
+
+Fitness values are cached by a hash of the (rounded) parameter values, so elites and repeated
+children are never run twice. After every generation the population and the cache are written
+to a state file; a later run with the same state file starts from that warm population, and
+reuses the cached fitness values if the fitness sessions are the same.
+
+    python evolve.py <trader type> [sweep file] [generations] [population size] [processes] [state file]
+
+The opponents, order schedule and session length come from the sweep file (sweeps/borsim.json by
+default); the evolved type trades against equal_ratio_n traders of each other type of the sweep.
+'''
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+
+import borsim
+import sweep
+import validation
+
+
+# the parameters evolved for each trader type, with their (low, high) bounds
+param_spaces = {'ZIP': {'beta': (0.1, 0.5), 'momntm': (0.0, 0.1), 'ca': (0.0, 0.1), 'cr': (0.0, 0.1)},
+                'AA': {'short_term_learning_rate': (0.1, 0.5), 'long_term_learning_rate': (0.1, 0.5),
+                       'theta_min': (-10.0, -2.0), 'theta_max': (1.0, 5.0)}}
+
+n_fitness_sessions = 10  # seeded market sessions per fitness evaluation
+n_elite = 2  # best candidates carried over unchanged to the next generation
+tournament_size = 3
+crossover_rate = 0.9  # chance that a child mixes two parents rather than copying one
+mutation_rate = 0.25  # chance that each parameter of a child is perturbed
+mutation_scale = 0.1  # standard deviation of a perturbation, as a fraction of the parameter's range
+param_digits = 6  # parameter values are rounded to this many decimals, so equal candidates hash equal
+
+
+# hash of a string, used to key the fitness cache and to tell fitness setups apart
+def digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def param_key(params):
+    return digest(json.dumps(sorted(params.items())))
+
+
+def clip(value, bounds):
+    (low, high) = bounds
+    return round(min(max(value, low), high), param_digits)
+
+
+def random_params(space, ga_random):
+    return dict([(name, clip(ga_random.uniform(*space[name]), space[name])) for name in space])
+
+
+# uniform crossover: each parameter comes from either parent
+def crossover(mother, father, ga_random):
+    return dict([(name, [mother, father][ga_random.randint(0, 1)][name]) for name in mother])
+
+
+# gaussian perturbation of some of the parameters, kept inside their bounds
+def mutate(params, space, ga_random):
+    child = dict(params)
+    for name in sorted(space):
+        if ga_random.random() < mutation_rate:
+            (low, high) = space[name]
+            child[name] = clip(child[name] + ga_random.gauss(0.0, mutation_scale * (high - low)), space[name])
+    return child
+
+
+def tournament(population, fitness, ga_random):
+    entrants = [ga_random.randint(0, len(population) - 1) for i in range(tournament_size)]
+    return population[max(entrants, key=lambda i: fitness[i])]
+
+
+# the fitness of one candidate and the number of profit-invariant violations in its sessions:
+# run in the pool's worker processes, so it only takes plain data
+def session_fitness(task):
+    (ttype, params, others, n, order_sched, start_time, end_time, seeds) = task
+    spec = [(ttype, n, params)] + [(other, n) for other in others]
+    # the workers share a working directory, so they must not dump their tapes there
+    borsim.tape_fname = None
+    dumpfile = open(os.devnull, 'w')
+    validator = validation.Validator(borsim.validation_mode, borsim.validation_sample_every)
+    profits = []
+    for seed in seeds:
+        random.seed(seed)
+        types, avg_balances = borsim.market_session('evolve-%d' % seed, start_time, end_time,
+                                                    {'buyers': spec, 'sellers': spec}, order_sched,
+                                                    dumpfile, False, False, validator)
+        profits.append(avg_balances[types.index(ttype)])
+    dumpfile.close()
+    return sum(profits) / float(len(profits)), len(validator.violations)
+
+
+class Evolution:
+
+    def __init__(self, ttype, others, n, order_sched, start_time, end_time, pool, seed=0):
+        if ttype not in param_spaces:
+            sys.exit('FATAL: no parameter space for trader type %s' % ttype)
+        self.ttype = ttype
+        self.space = param_spaces[ttype]
+        self.task = (others, n, order_sched, start_time, end_time, list(range(n_fitness_sessions)))
+        # cached fitness values are only valid for the same fitness sessions
+        self.setup = digest(json.dumps([ttype] + list(self.task), sort_keys=True))
+        self.pool = pool
+        self.ga_random = random.Random(seed)
+        self.cache = {}  # param_key -> fitness
+        self.population = []
+        self.generation = 0
+        self.n_violations = 0  # profit-invariant violations in the fitness sessions run so far
+
+    # start from the population of a state file, if there is one
+    def load(self, fname):
+        if not os.path.exists(fname):
+            return False
+        state_file = open(fname, 'r')
+        state = json.load(state_file)
+        state_file.close()
+        if state['ttype'] != self.ttype:
+            sys.exit('FATAL: state file %s evolves %s, not %s' % (fname, state['ttype'], self.ttype))
+        self.population = [dict([(str(name), p[name]) for name in p]) for p in state['population']]
+        self.generation = state['generation']
+        if state['setup'] == self.setup:
+            self.cache = state['cache']
+        return True
+
+    # written to a temporary file and renamed over the old one, as results.StreamingAggregator does
+    def save(self, fname):
+        tmp_fname = fname + '.tmp'
+        state_file = open(tmp_fname, 'w')
+        json.dump({'ttype': self.ttype, 'setup': self.setup, 'generation': self.generation,
+                   'population': self.population, 'cache': self.cache}, state_file, sort_keys=True)
+        state_file.close()
+        if os.name == 'nt' and os.path.exists(fname):
+            os.remove(fname)  # rename does not replace an existing file on Windows
+        os.rename(tmp_fname, fname)
+
+    # fitness of every candidate; only candidates not in the cache are run, each of them once
+    def evaluate(self, population):
+        new = {}
+        for params in population:
+            key = param_key(params)
+            if key not in self.cache:
+                new[key] = params
+        keys = sorted(new)
+        tasks = [(self.ttype, new[key]) + self.task for key in keys]
+        for key, (fitness, n_violations) in zip(keys, self.pool.map(session_fitness, tasks)):
+            self.cache[key] = fitness
+            self.n_violations += n_violations
+        return [self.cache[param_key(params)] for params in population]
+
+    def next_population(self, fitness):
+        ranked = sorted(range(len(self.population)), key=lambda i: -fitness[i])
+        children = [self.population[i] for i in ranked[:n_elite]]
+        while len(children) < len(self.population):
+            mother = tournament(self.population, fitness, self.ga_random)
+            if self.ga_random.random() < crossover_rate:
+                child = crossover(mother, tournament(self.population, fitness, self.ga_random), self.ga_random)
+            else:
+                child = dict(mother)
+            children.append(mutate(child, self.space, self.ga_random))
+        return children
+
+    # run n_generations, starting from the current population topped up to pop_size with random
+    # candidates; yields (generation, fitness of the population) after every generation
+    def run(self, n_generations, pop_size, state_fname=None):
+        self.population = self.population[:pop_size]
+        while len(self.population) < pop_size:
+            self.population.append(random_params(self.space, self.ga_random))
+        for g in range(n_generations):
+            fitness = self.evaluate(self.population)
+            self.generation += 1
+            yield self.generation, fitness
+            self.population = self.next_population(fitness)
+            if state_fname != None:
+                self.save(state_fname)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit('usage: python evolve.py <trader type> [sweep file] [generations] [population size] '
+                 '[processes] [state file]')
+    ttype = sys.argv[1]
+    sweep_fname = 'sweeps/borsim.json'
+    n_generations = 20
+    pop_size = 16
+    processes = multiprocessing.cpu_count()
+    if len(sys.argv) > 2:
+        sweep_fname = sys.argv[2]
+    if len(sys.argv) > 3:
+        n_generations = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        pop_size = int(sys.argv[4])
+    if len(sys.argv) > 5:
+        processes = int(sys.argv[5])
+    state_fname = 'evolve_%s.json' % ttype
+    if len(sys.argv) > 6:
+        state_fname = sys.argv[6]
+    sweep_def = sweep.load_sweep(sweep_fname)
+
+    schedule_source = sweep_def['schedule']
+    if schedule_source['source'] == 'random':
+        random.seed(0)
+        order_sched = borsim.random_order_schedule(**schedule_source['params'])
+    elif schedule_source['source'] == 'file':
+        order_sched = sweep.load_schedule(schedule_source['path'])
+    else:
+        sys.exit('FATAL: evolve needs a random or file schedule, not %s' % schedule_source['source'])
+
+    others = [other for other in sweep_def['trader_types'] if other != ttype]
+    n = sweep_def['n_traders'] // len(sweep_def['trader_types'])
+
+    pool = multiprocessing.Pool(processes)
+    evolution = Evolution(ttype, others, n, order_sched, sweep_def['start_time'], sweep_def['end_time'], pool)
+    if evolution.load(state_fname):
+        print('warm start from %s: generation %d, %d cached fitness values'
+              % (state_fname, evolution.generation, len(evolution.cache)))
+    print('%10s %12s %12s  %s' % ('generation', 'best', 'mean', 'best parameters'))
+    for generation, fitness in evolution.run(n_generations, pop_size, state_fname):
+        best = max(range(len(fitness)), key=lambda i: fitness[i])
+        params = evolution.population[best]
+        print('%10d %12.2f %12.2f  %s' % (generation, fitness[best], sum(fitness) / len(fitness),
+                                          ', '.join(['%s=%g' % (name, params[name]) for name in sorted(params)])))
+    pool.close()
+    pool.join()
+    if evolution.n_violations > 0:
+        print('%d profit-invariant violations in the fitness sessions' % evolution.n_violations)
@@ -0,0 +1,67 @@
+'''
+Exchange-side rounding of quote prices to a tick grid.
+
+Without a quantiser the exchanges take prices as the traders quote them: AA and GDX quote fractional
+prices, so every quote can open a price level of its own. A PriceQuantiser rounds each quote to a
+multiple of its tick before the quote is checked and reaches the book, with a rounding policy per
+side: 'down', 'up', 'nearest' or 'none'. The default rounds bids down and asks up, so no quote is
+moved past its trader's limit. Rounded prices are clamped to the simulator's price range.
+
+A sweep turns it on with its "price_quantiser" setting, e.g.
+    "price_quantiser": {"tick": 1, "bid_rounding": "down", "ask_rounding": "up"}
+where every key is optional (the tick defaults to the simulator's ticksize).
+'''
+import math
+import sys
+
+
+class PriceQuantiser:
+
+    policies = ('down', 'up', 'nearest', 'none')
+
+    def __init__(self, tick=1, bid_rounding='down', ask_rounding='up', minprice=None, maxprice=None):
+        for rounding in (bid_rounding, ask_rounding):
+            if rounding not in self.policies:
+                sys.exit('FATAL: unknown price rounding %s' % rounding)
+        self.tick = tick
+        self.rounding = {'Bid': bid_rounding, 'Ask': ask_rounding}
+        self.minprice = minprice
+        self.maxprice = maxprice
+
+    def quantise(self, price, otype):
+        rounding = self.rounding[otype]
+        if rounding == 'none':
+            return price
+        steps = price / float(self.tick)
+        nearest = math.floor(steps + 0.5)
+        if rounding == 'nearest' or abs(steps - nearest) < 1e-9:
+            # prices already on the grid stay there, whatever float error they carry
+            n = nearest
+        elif rounding == 'down':
+            n = math.floor(steps)
+        else:
+            n = math.ceil(steps)
+        if self.tick == int(self.tick):
+            price = int(n) * int(self.tick)
+        else:
+            price = n * self.tick
+        # rounding must not take a price out of the system's range (0.6 rounded down is 0)
+        if self.minprice != None and price < self.minprice:
+            price = self.minprice
+        if self.maxprice != None and price > self.maxprice:
+            price = self.maxprice
+        return price
+
+
+# the quantiser for a sweep's "price_quantiser" setting (None for no quantiser), on the price range
+# and default tick of the simulator that uses it
+def from_setting(setting, tick, minprice, maxprice):
+    if setting == None:
+        return None
+    params = {'tick': tick, 'bid_rounding': 'down', 'ask_rounding': 'up'}
+    for key in setting:
+        if key not in params:
+            sys.exit('FATAL: unknown price_quantiser setting %s' % key)
+        params[str(key)] = setting[key]
+    return PriceQuantiser(params['tick'], str(params['bid_rounding']), str(params['ask_rounding']),
+                          minprice, maxprice)
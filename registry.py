@@ -0,0 +1,42 @@
+'''
+Registry of the trader strategies that populate_market() can build.
+
+Each simulator module keeps one TraderRegistry, and every strategy registers itself under its
+robot type right after its class is defined:
+
+    trader_registry.register('ZIC', Trader_ZIC)
+
+A strategy can also live in a module of its own and be registered as 'module:Class'. That module
+is only imported the first time a trader spec uses the type, so workers that never run a strategy
+never pay for importing it, and new strategy engines can be plugged in without editing the harness.
+'''
+import importlib
+import sys
+
+
+class TraderRegistry:
+
+    def __init__(self):
+        self.entries = {}  # robot type -> trader class, or 'module:Class' until first used
+
+    def register(self, robottype, cls):
+        self.entries[robottype] = cls
+
+    def __contains__(self, robottype):
+        return robottype in self.entries
+
+    # the trader class of a robot type, importing its module if it was registered by name
+    def lookup(self, robottype):
+        if robottype not in self.entries:
+            sys.exit('FATAL: don\'t know robot type %s\n' % robottype)
+        cls = self.entries[robottype]
+        if isinstance(cls, str):
+            if ':' not in cls:
+                sys.exit('FATAL: robot type %s is registered as %s, not module:Class\n' % (robottype, cls))
+            module_name, class_name = cls.split(':', 1)
+            module = importlib.import_module(module_name)
+            if not hasattr(module, class_name):
+                sys.exit('FATAL: module %s has no trader class %s\n' % (module_name, class_name))
+            cls = getattr(module, class_name)
+            self.entries[robottype] = cls
+        return cls
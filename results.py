@@ -0,0 +1,188 @@
+'''
+Result sinks for the per-session trade_stats rows.
+
+Rows are kept in memory and written out in large chunks instead of many small line-buffered
+writes. Only whole rows are ever written, and checkpoint() makes everything so far durable
+(flush + fsync), so a crashed or killed sweep leaves a file that ends on a complete row.
+
+Two layouts are available:
+    'csv'   -- the existing trade_stats layout: expid, time, then type, balance, n, profit per
+               trader for each type present in the session, then best bid and best ask
+    'typed' -- one fixed group of columns per trader type (balance, n, profit per trader), in the
+               order given when the sink is created, so every type is always in the same columns
+               and absent types are written as zero traders
+
+A sink can also feed a StreamingAggregator, which keeps running statistics of the profit per
+trader for every (stage, noise probability, ratio, trader type) as rows arrive and rewrites a small
+summary file at each checkpoint, so a long sweep can be watched without re-reading the results.
+'''
+import math
+import os
+import sys
+
+
+# one trade_stats row in the existing CSV layout
+# type_stats is a list of (type, balance sum, number of traders), sorted by type
+def csv_row(expid, time, type_stats, best_bid, best_ask):
+    fields = ['%s, %06d, ' % (expid, time)]
+    for (ttype, s, n) in type_stats:
+        fields.append('%s, %d, %d, %f, ' % (ttype, s, n, s / float(n)))
+    fields.append(best_price_field(best_bid))
+    fields.append(best_price_field(best_ask))
+    fields.append('\n')
+    return ''.join(fields)
+
+
+def best_price_field(price):
+    if price != None:
+        return '%d, ' % price
+    return 'N, '
+
+
+# summary file name that goes with a results file: balances.csv -> balances_summary.csv
+def summary_fname(fname):
+    dot = fname.rfind('.')
+    if dot < 0:
+        dot = len(fname)
+    return '%s_summary%s' % (fname[:dot], fname[dot:])
+
+
+# running count, mean and variance of a stream of values (Welford's method)
+class RunningStats:
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    # sample variance; zero until there are two values
+    def variance(self):
+        if self.n < 2:
+            return 0.0
+        return self.m2 / (self.n - 1)
+
+
+class StreamingAggregator:
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.stats = {}  # (stage, noise probability, ratio, type) -> RunningStats of profit per trader
+
+    # add one session: group is (stage, noise probability, ratio), type_stats as for csv_row
+    def update(self, group, type_stats):
+        for (ttype, s, n) in type_stats:
+            key = group + (ttype,)
+            if key not in self.stats:
+                self.stats[key] = RunningStats()
+            self.stats[key].update(s / float(n))
+
+    # rewrite the summary file; it is written to a temporary file and renamed over the old one,
+    # so a reader never sees a half-written summary
+    def write_summary(self):
+        tmp_fname = self.fname + '.tmp'
+        summary = open(tmp_fname, 'w')
+        summary.write('%s, %s, %s, %s, %s, %s, %s, %s\n' % ('stage', 'noise probability', 'ratio', 'type',
+                                                          'sessions', 'mean profit per trader', 'variance',
+                                                          'standard error'))
+        for key in sorted(self.stats):
+            (stage, noise_probability, ratio, ttype) = key
+            stats = self.stats[key]
+            variance = stats.variance()
+            summary.write('%s, %s, %s, %s, %d, %f, %f, %f\n' % (stage, noise_probability,
+                                                             ':'.join([str(n) for n in ratio]), ttype,
+                                                             stats.n, stats.mean, variance,
+                                                             math.sqrt(variance / stats.n)))
+        summary.flush()
+        os.fsync(summary.fileno())
+        summary.close()
+        if os.name == 'nt' and os.path.exists(self.fname):
+            os.remove(self.fname)  # rename does not replace an existing file on Windows
+        os.rename(tmp_fname, self.fname)
+
+
+class ResultSink:
+
+    def __init__(self, fname, trader_types, fmt='csv', buffer_rows=1000, aggregator=None):
+        if fmt not in ('csv', 'typed'):
+            sys.exit('FATAL: unknown result format %s' % fmt)
+        self.fname = fname
+        self.fmt = fmt
+        self.trader_types = list(trader_types)
+        self.buffer_rows = buffer_rows  # rows held in memory before they are written out
+        self.rows = []
+        self.n_rows = 0  # lines written to the file so far
+        self.aggregator = aggregator
+        self.context = ()  # (noise probability, ratio) of the sessions being written, for the aggregator
+        self.file = open(fname, 'w')
+        self.rows.append(self.header())
+        self.checkpoint()
+
+    def header(self):
+        fields = ['%s, %s, ' % ('expid', 'time')]
+        if self.fmt == 'csv':
+            for ttype in self.trader_types:
+                fields.append('%s, %s, %s, %s, ' % ('type', 'balance', 'number of traders', 'profit per trader'))
+        else:
+            for ttype in self.trader_types:
+                fields.append('%s balance, %s n, %s profit per trader, ' % (ttype, ttype, ttype))
+            fields.append('%s, %s, ' % ('best bid', 'best ask'))
+        fields.append('\n')
+        return ''.join(fields)
+
+    def typed_row(self, expid, time, type_stats, best_bid, best_ask):
+        stats = {}
+        for (ttype, s, n) in type_stats:
+            if ttype not in self.trader_types:
+                sys.exit('FATAL: trader type %s has no column in %s' % (ttype, self.fname))
+            stats[ttype] = (s, n)
+        fields = ['%s, %06d, ' % (expid, time)]
+        for ttype in self.trader_types:
+            if ttype in stats:
+                (s, n) = stats[ttype]
+                fields.append('%d, %d, %f, ' % (s, n, s / float(n)))
+            else:
+                fields.append('0, 0, , ')
+        fields.append(best_price_field(best_bid))
+        fields.append(best_price_field(best_ask))
+        fields.append('\n')
+        return ''.join(fields)
+
+    # add one session's statistics
+    def write_stats(self, expid, time, type_stats, best_bid, best_ask):
+        if self.fmt == 'csv':
+            self.rows.append(csv_row(expid, time, type_stats, best_bid, best_ask))
+        else:
+            self.rows.append(self.typed_row(expid, time, type_stats, best_bid, best_ask))
+        if self.aggregator != None:
+            # trial ids end in -base or -enhanced
+            stage = ''
+            if '-' in expid:
+                stage = expid[expid.rfind('-') + 1:]
+            self.aggregator.update((stage,) + self.context, type_stats)
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    # write out the buffered rows in one chunk
+    def flush(self):
+        if len(self.rows) > 0:
+            self.file.write(''.join(self.rows))
+            self.n_rows += len(self.rows)
+            self.rows = []
+        self.file.flush()
+
+    # crash-safe point: everything written so far is on disk
+    def checkpoint(self):
+        self.flush()
+        os.fsync(self.file.fileno())
+        if self.aggregator != None:
+            self.aggregator.write_summary()
+
+    def close(self):
+        self.checkpoint()
+        self.file.close()
@@ -48,6 +48,14 @@
 import sys
 import math
 import random
+import bisect
+import collections
+
+import quantiser
+import registry
+import sweep
+import tradehistory
+import validation
 
 
 bse_sys_minprice = 1  # minimum price in the system, in cents/pennies
@@ -202,6 +210,11 @@ class Orderbook_half:
 
 
 
+# how the exchange puts quote prices on the tick grid: None takes prices as the traders quote them,
+# or a quantiser.PriceQuantiser that rounds them before they reach the book (see the sweep's price_quantiser)
+price_quantiser = None
+
+
 # Orderbook for a single instrument: list of bids and list of asks
 
 class Orderbook(Orderbook_half):
@@ -210,7 +223,9 @@ class Orderbook(Orderbook_half):
                 self.bids = Orderbook_half('Bid', bse_sys_minprice)
                 self.asks = Orderbook_half('Ask', bse_sys_maxprice)
                 self.tape = []
+                self.history = tradehistory.TradeHistory()  # the trades on the tape, indexed by time
                 self.quote_id = 0  #unique ID code for each quote accepted onto the book
+                self.quantiser = price_quantiser
 
 
 
@@ -269,6 +284,12 @@ class Exchange(Orderbook):
 
 
 
+        # put an order's price on the quantiser's grid, before it is checked and sent to process_order2()
+        def quantise(self, order):
+                if self.quantiser != None:
+                        order.price = self.quantiser.quantise(order.price, order.otype)
+
+
         def process_order2(self, time, order, verbose):
                 # receive an order and either add it to the relevant LOB (ie treat as limit order)
                 # or if it crosses the best counterparty offer, execute it (treat as a market order)
@@ -323,6 +344,7 @@ class Exchange(Orderbook):
                                                'qty': order.qty
                                               }
                         self.tape.append(transaction_record)
+                        self.history.record(time, price, order.qty)
                         return transaction_record
                 else:
                         return None
@@ -354,6 +376,7 @@ class Exchange(Orderbook):
                                      'lob':self.asks.lob_anon}
                 public_data['QID'] = self.quote_id
                 public_data['tape'] = self.tape
+                public_data['trades'] = self.history
                 if verbose:
                         print('publish_lob: t=%d' % time)
                         print('BID_lob=%s' % public_data['bids']['lob'])
@@ -371,15 +394,56 @@ class Exchange(Orderbook):
 ##################--Traders below here--#############
 
 
+# what each trader keeps of its own trades (Trader.blotter):
+# 'full' keeps every trade record, 'window' the last blotter_window of them,
+# and 'aggregate' only the number of trades, their total profit and the times of the first and last
+# (set from the sweep's "blotter_mode")
+blotter_mode = 'full'
+blotter_window = 100
+
+
+# an empty blotter for the current blotter_mode
+def new_blotter():
+        if blotter_mode == 'full':
+                return []
+        elif blotter_mode == 'window':
+                return collections.deque(maxlen=blotter_window)
+        elif blotter_mode == 'aggregate':
+                return {'n': 0, 'profit': 0, 'first_time': None, 'last_time': None}
+        else:
+                sys.exit('FATAL: unknown blotter mode %s' % blotter_mode)
+
+
+# add one trade and the profit made on it to a blotter made by new_blotter()
+def record_trade(blotter, trade, profit):
+        if isinstance(blotter, dict):
+                blotter['n'] += 1
+                blotter['profit'] += profit
+                if blotter['first_time'] is None:
+                        blotter['first_time'] = trade['time']
+                blotter['last_time'] = trade['time']
+        else:
+                blotter.append(trade)
+
+
+# robot type -> trader class, filled in as the trader classes below are defined (see registry.py)
+trader_registry = registry.TraderRegistry()
+
+
 # Trader superclass
 # all Traders have a trader id, bank balance, blotter, and list of orders to execute
-class Trader:
+class Trader(object):
+
+        # traders have fixed attribute sets, so no per-instance __dict__ is kept; every subclass lists
+        # the attributes it adds in its own __slots__ (an empty tuple if it adds none)
+        __slots__ = ('ttype', 'tid', 'balance', 'blotter', 'orders', 'n_quotes', 'willing', 'able',
+                     'birthtime', 'profitpertime', 'n_trades', 'lastquote')
 
         def __init__(self, ttype, tid, balance, time):
                 self.ttype = ttype      # what type / strategy this trader is
                 self.tid = tid          # trader unique ID code
                 self.balance = balance  # money in the bank
-                self.blotter = []       # record of trades executed
+                self.blotter = new_blotter()  # record of trades executed
                 self.orders = []        # customer orders currently being worked (fixed at 1)
                 self.n_quotes = 0       # number of quotes live on LOB
                 self.willing = 1        # used in ZIP etc
@@ -420,7 +484,6 @@ class Trader:
                 outstr=""
                 for order in self.orders: outstr = outstr + str(order)
 
-                self.blotter.append(trade)  # add trade record to trader's blotter
                 # NB What follows is **LAZY** -- assumes all orders are quantity=1
                 transactionprice = trade['price']
                 if self.orders[0].otype == 'Bid':
@@ -428,15 +491,10 @@ class Trader:
                 else:
                         profit = transactionprice - self.orders[0].price
                 self.balance += profit
+                record_trade(self.blotter, trade, profit)  # add trade record to trader's blotter
                 self.n_trades += 1
                 self.profitpertime = self.balance/(time - self.birthtime)
 
-                if profit < 0 :
-                        print profit
-                        print trade
-                        print order
-                        sys.exit()
-
                 if verbose: print('%s profit=%d balance=%d profit/time=%d' % (outstr, profit, self.balance, self.profitpertime))
                 self.del_order(order)  # delete the order
 
@@ -458,6 +516,8 @@ class Trader:
 # (but never makes a loss)
 class Trader_Giveaway(Trader):
 
+        __slots__ = ()
+
         def getorder(self, time, countdown, lob):
                 if len(self.orders) < 1:
                         order = None
@@ -471,9 +531,17 @@ class Trader_Giveaway(Trader):
                         self.lastquote=order
                 return order
 
+
 # Trader subclass AA
 class Trader_AA(Trader):
 
+        __slots__ = ('limit', 'job', 'r_shout_change_relative', 'r_shout_change_absolute',
+                     'short_term_learning_rate', 'long_term_learning_rate', 'moving_average_weight_decay',
+                     'moving_average_window_size', 'offer_change_rate', 'theta', 'theta_max', 'theta_min',
+                     'marketMax', 'trades', 'moving_average_weights', 'estimated_equilibrium',
+                     'smiths_alpha', 'prev_best_bid_p', 'prev_best_bid_q', 'prev_best_ask_p',
+                     'prev_best_ask_q', 'r_shout', 'buy_target', 'sell_target', 'buy_r', 'sell_r', 'active')
+
         def __init__(self, ttype, tid, balance, time):
                 # Stuff about trader
                 self.ttype = ttype
@@ -482,7 +550,7 @@ class Trader_AA(Trader):
                 self.birthtime = time
                 self.profitpertime = 0
                 self.n_trades = 0
-                self.blotter = []
+                self.blotter = new_blotter()
                 self.orders = []
                 self.n_quotes = 0
                 self.lastquote = None
@@ -504,7 +572,7 @@ class Trader_AA(Trader):
                 self.marketMax = bse_sys_maxprice
 
                 # Variables to describe the market
-                self.previous_transactions = []
+                self.trades = None  # the exchange's trade history (lob['trades']), see previous_transactions
                 self.moving_average_weights = []
                 for i in range(self.moving_average_window_size):
                         self.moving_average_weights.append(self.moving_average_weight_decay**i)
@@ -524,6 +592,13 @@ class Trader_AA(Trader):
 
 
 
+        # prices of the last moving_average_window_size trades, oldest first; nothing older is used
+        @property
+        def previous_transactions(self):
+                if self.trades == None:
+                        return []
+                return self.trades.last(self.moving_average_window_size)
+
         def calcEq(self):
                 # Slightly modified from paper, it is unclear inpaper
                 # N previous transactions * weights / N in vytelingum, swap N denominator for sum of weights to be correct?
@@ -672,6 +747,7 @@ class Trader_AA(Trader):
                         self.active = True
                         self.limit = self.orders[0].price
                         self.job = self.orders[0].otype
+                        self.trades = lob['trades']
                         self.calcTarget()
 
                         if self.prev_best_bid_p == None:
@@ -718,6 +794,8 @@ class Trader_AA(Trader):
                 return order
 
         def respond(self, time, lob, trade, verbose):
+            self.trades = lob['trades']
+
             ## Begin nicked from ZIP
 
             # what, if anything, has happened on the bid LOB? Nicked from ZIP..
@@ -775,7 +853,6 @@ class Trader_AA(Trader):
             ## End nicked from ZIP
 
             if deal:
-                    self.previous_transactions.append(trade['price'])
                     if self.sell_target == None:
                             self.sell_target = trade['price']
                     if self.buy_target == None:
@@ -789,11 +866,16 @@ class Trader_AA(Trader):
                     #print 'sell: ', self.sell_target, 'buy: ', self.buy_target, 'limit:', self.limit, 'eq: ',  self.estimated_equilibrium[-1], 'sell_r: ', self.sell_r, 'buy_r: ', self.buy_r, '\n'
 
 
+trader_registry.register('AA', Trader_AA)
+
+
 
 # Trader subclass ZI-C
 # After Gode & Sunder 1993
 class Trader_ZIC(Trader):
 
+        __slots__ = ()
+
         def getorder(self, time, countdown, lob):
                 if len(self.orders) < 1:
                         # no orders: return NULL
@@ -814,11 +896,16 @@ class Trader_ZIC(Trader):
                 return order
 
 
+trader_registry.register('ZIC', Trader_ZIC)
+
+
 # Trader subclass Shaver
 # shaves a penny off the best price
 # if there is no best price, creates "stub quote" at system max/min
 class Trader_Shaver(Trader):
 
+        __slots__ = ()
+
         def getorder(self, time, countdown, lob):
                 if len(self.orders) < 1:
                         order = None
@@ -850,6 +937,8 @@ class Trader_Shaver(Trader):
 # then gets increasing aggressive, increasing "shave thickness" as time runs out
 class Trader_Sniper(Trader):
 
+        __slots__ = ()
+
         def getorder(self, time, countdown, lob):
                 lurk_threshold = 0.2
                 shavegrowthrate = 3
@@ -879,6 +968,9 @@ class Trader_Sniper(Trader):
                 return order
 
 
+trader_registry.register('SNPR', Trader_Sniper)
+
+
 
 
 # Trader subclass ZIP
@@ -890,6 +982,10 @@ class Trader_ASAD(Trader):
         #    so a single trader can both buy AND sell
         #    -- in the original, traders were either buyers OR sellers
 
+        __slots__ = ('prev_orders', 'prev_sumy', 'prev_sumxy', 'job', 'active', 'prev_change', 'beta',
+                     'momntm', 'ca', 'cr', 'margin', 'margin_buy', 'margin_sell', 'price', 'limit', 'phi',
+                     'prev_best_bid_p', 'prev_best_bid_q', 'prev_best_ask_p', 'prev_best_ask_q')
+
         def __init__(self, ttype, tid, balance, time):
                 self.ttype = ttype
                 self.tid = tid
@@ -897,9 +993,13 @@ class Trader_ASAD(Trader):
                 self.birthtime = time
                 self.profitpertime = 0
                 self.n_trades = 0
-                self.blotter = []
+                self.blotter = new_blotter()
                 self.orders = []
-                self.prev_orders = []
+                # the last 20 quotes, with running sums of their prices y and of i*y (i = 0 for the oldest),
+                # for the rolling least-squares slope in calc_phi()
+                self.prev_orders = collections.deque(maxlen=20)
+                self.prev_sumy = 0
+                self.prev_sumxy = 0
                 self.n_quotes = 0
                 self.lastquote = None
                 self.job = None  # this gets switched to 'Bid' or 'Ask' depending on order-type
@@ -941,6 +1041,14 @@ class Trader_ASAD(Trader):
 
                         order = Order(self.tid, self.job, quoteprice, self.orders[0].qty, time, lob['QID'])
                         self.lastquote = order
+                        if len(self.prev_orders) == self.prev_orders.maxlen:
+                                # the oldest quote drops out and every other one moves down a place
+                                oldest = self.prev_orders[0].price
+                                self.prev_sumxy = self.prev_sumxy - (self.prev_sumy - oldest) + (self.prev_orders.maxlen - 1) * quoteprice
+                                self.prev_sumy = self.prev_sumy - oldest + quoteprice
+                        else:
+                                self.prev_sumxy = self.prev_sumxy + len(self.prev_orders) * quoteprice
+                                self.prev_sumy = self.prev_sumy + quoteprice
                         self.prev_orders.append(order)
                 return order
 
@@ -1001,15 +1109,10 @@ class Trader_ASAD(Trader):
                 def calc_phi():
                         if len(self.prev_orders) < 20:
                                 return
-                        sumxy = 0
-                        sumx = 0
-                        sumxsq = 0
-                        sumy = 0
-                        for i in range(20):
-                                sumxy = sumxy + i * self.prev_orders[-20:][i].price
-                                sumx =  sumx + i
-                                sumxsq = sumxsq + i*i
-                                sumy = sumy + self.prev_orders[-20:][i].price
+                        sumxy = self.prev_sumxy
+                        sumx = 190  # sum of i for i in range(20)
+                        sumxsq = 2470  # sum of i*i for i in range(20)
+                        sumy = self.prev_sumy
                         delta = (sumxy - (sumy * sumx / 20)) / (sumxsq - (sumx * sumx / 20))
                         if delta < 0:
                                 self.phi = -math.log(1-delta)
@@ -1129,10 +1232,19 @@ class Trader_ASAD(Trader):
                 self.prev_best_ask_q = lob_best_ask_q
 
 
+trader_registry.register('ASAD', Trader_ASAD)
+
+
 # Trader subclass ZIP
 # After Cliff 1997
 class Trader_GDX(Trader):
 
+        __slots__ = ('prev_orders', 'job', 'active', 'outstanding_bids', 'outstanding_asks', 'accepted_asks',
+                     'accepted_bids', 'outstanding_bid_prices', 'outstanding_ask_prices',
+                     'sorted_accepted_asks', 'sorted_accepted_bids', 'price', 'prev_best_bid_p',
+                     'prev_best_bid_q', 'prev_best_ask_p', 'prev_best_ask_q', 'first_turn', 'gamma',
+                     'holdings', 'remaining_offer_ops', 'values', 'limit')
+
         def __init__(self, ttype, tid, balance, time):
                 self.ttype = ttype
                 self.tid = tid
@@ -1140,7 +1252,7 @@ class Trader_GDX(Trader):
                 self.birthtime = time
                 self.profitpertime = 0
                 self.n_trades = 0
-                self.blotter = []
+                self.blotter = new_blotter()
                 self.orders = []
                 self.prev_orders = []
                 self.n_quotes = 0
@@ -1153,6 +1265,12 @@ class Trader_GDX(Trader):
                 self.outstanding_asks = []
                 self.accepted_asks = []
                 self.accepted_bids = []
+                # the same prices kept sorted, so that beliefs are counted by binary search:
+                # the insertion point of a price in a sorted list is the number of entries below it
+                self.outstanding_bid_prices = []
+                self.outstanding_ask_prices = []
+                self.sorted_accepted_asks = []
+                self.sorted_accepted_bids = []
 
                 self.price = -1
 
@@ -1254,36 +1372,18 @@ class Trader_GDX(Trader):
                 return best_ask
 
         def belief_sell(self, price):
-                accepted_asks_greater = 0
-                bids_greater = 0
-                unaccepted_asks_lower = 0
-                for p in self.accepted_asks:
-                        if p >= price:
-                                accepted_asks_greater += 1
-                for p in [thing[0] for thing in self.outstanding_bids]:
-                        if p >= price:
-                                bids_greater += 1
-                for p in [thing[0] for thing in self.outstanding_asks]:
-                        if p <= price:
-                                unaccepted_asks_lower += 1
+                accepted_asks_greater = len(self.sorted_accepted_asks) - bisect.bisect_left(self.sorted_accepted_asks, price)
+                bids_greater = len(self.outstanding_bid_prices) - bisect.bisect_left(self.outstanding_bid_prices, price)
+                unaccepted_asks_lower = bisect.bisect_right(self.outstanding_ask_prices, price)
 
                 if accepted_asks_greater + bids_greater + unaccepted_asks_lower == 0:
                         return 0
                 return (accepted_asks_greater + bids_greater) / (accepted_asks_greater + bids_greater + unaccepted_asks_lower)
 
         def belief_buy(self, price):
-                accepted_bids_lower = 0
-                asks_lower = 0
-                unaccepted_bids_greater = 0
-                for p in self.accepted_bids:
-                        if p <= price:
-                                accepted_bids_lower += 1
-                for p in [thing[0] for thing in self.outstanding_asks]:
-                        if p <= price:
-                                asks_lower += 1
-                for p in [thing[0] for thing in self.outstanding_bids]:
-                        if p >= price:
-                                unaccepted_bids_greater += 1
+                accepted_bids_lower = bisect.bisect_right(self.sorted_accepted_bids, price)
+                asks_lower = bisect.bisect_right(self.outstanding_ask_prices, price)
+                unaccepted_bids_greater = len(self.outstanding_bid_prices) - bisect.bisect_left(self.outstanding_bid_prices, price)
                 if accepted_bids_lower + asks_lower + unaccepted_bids_greater == 0:
                         return 0
                 return (accepted_bids_lower + asks_lower) / (accepted_bids_lower + asks_lower + unaccepted_bids_greater)
@@ -1291,6 +1391,7 @@ class Trader_GDX(Trader):
         def respond(self, time, lob, trade, verbose):
                 # what, if anything, has happened on the bid LOB?
                 self.outstanding_bids = lob['bids']['lob']
+                self.outstanding_bid_prices = sorted([thing[0] for thing in self.outstanding_bids])
                 bid_improved = False
                 bid_hit = False
                 lob_best_bid_p = lob['bids']['best']
@@ -1305,6 +1406,7 @@ class Trader_GDX(Trader):
                         elif trade != None and ((self.prev_best_bid_p > lob_best_bid_p) or ((self.prev_best_bid_p == lob_best_bid_p) and (self.prev_best_bid_q > lob_best_bid_q))):
                                 # previous best bid was hit
                                 self.accepted_bids.append(self.prev_best_bid_p)
+                                bisect.insort(self.sorted_accepted_bids, self.prev_best_bid_p)
                                 bid_hit = True
                 elif self.prev_best_bid_p != None:
                         # the bid LOB has been emptied: was it cancelled or hit?
@@ -1316,6 +1418,7 @@ class Trader_GDX(Trader):
 
                 # what, if anything, has happened on the ask LOB?
                 self.outstanding_asks = lob['asks']['lob']
+                self.outstanding_ask_prices = sorted([thing[0] for thing in self.outstanding_asks])
                 ask_improved = False
                 ask_lifted = False
                 lob_best_ask_p = lob['asks']['best']
@@ -1329,6 +1432,7 @@ class Trader_GDX(Trader):
                         elif trade != None and ((self.prev_best_ask_p < lob_best_ask_p) or ((self.prev_best_ask_p == lob_best_ask_p) and (self.prev_best_ask_q > lob_best_ask_q))):
                                 # trade happened and best ask price has got worse, or stayed same but quantity reduced -- assume previous best ask was lifted
                                 self.accepted_asks.append(self.prev_best_ask_p)
+                                bisect.insort(self.sorted_accepted_asks, self.prev_best_ask_p)
                                 ask_lifted = True
                 elif self.prev_best_ask_p != None:
                         # the ask LOB is empty now but was not previously: canceled or lifted?
@@ -1365,6 +1469,9 @@ class Trader_GDX(Trader):
                 self.prev_best_ask_q = lob_best_ask_q
 
 
+trader_registry.register('GDX', Trader_GDX)
+
+
 
 
 # Trader subclass ZIP
@@ -1376,6 +1483,10 @@ class Trader_ZIP(Trader):
         #    so a single trader can both buy AND sell
         #    -- in the original, traders were either buyers OR sellers
 
+        __slots__ = ('job', 'active', 'prev_change', 'beta', 'momntm', 'ca', 'cr', 'margin', 'margin_buy',
+                     'margin_sell', 'price', 'limit', 'prev_best_bid_p', 'prev_best_bid_q', 'prev_best_ask_p',
+                     'prev_best_ask_q')
+
         def __init__(self, ttype, tid, balance, time):
                 self.ttype = ttype
                 self.tid = tid
@@ -1383,7 +1494,7 @@ class Trader_ZIP(Trader):
                 self.birthtime = time
                 self.profitpertime = 0
                 self.n_trades = 0
-                self.blotter = []
+                self.blotter = new_blotter()
                 self.orders = []
                 self.n_quotes = 0
                 self.lastquote = None
@@ -1584,6 +1695,9 @@ class Trader_ZIP(Trader):
                 self.prev_best_ask_q = lob_best_ask_q
 
 
+trader_registry.register('ZIP', Trader_ZIP)
+
+
 
 
 ##########################---trader-types have all been defined now--################
@@ -1670,20 +1784,7 @@ def trade_stats(expid, traders, dumpfile, time, lob):
 def populate_market(traders_spec, traders, shuffle, verbose):
 
         def trader_type(robottype, name):
-                if robottype == 'AA':
-                        return Trader_AA('AA', name, 0.00, 0)
-                elif robottype == 'ZIC':
-                        return Trader_ZIC('ZIC', name, 0.00, 0)
-                elif robottype == 'GDX':
-                        return Trader_GDX('GDX', name, 0.00, 0)
-                elif robottype == 'SNPR':
-                        return Trader_Sniper('SNPR', name, 0.00, 0)
-                elif robottype == 'ZIP':
-                        return Trader_ZIP('ZIP', name, 0.00, 0)
-                elif robottype == 'ASAD':
-                        return Trader_ASAD('ASAD', name, 0.00, 0)
-                else:
-                        sys.exit('FATAL: don\'t know robot type %s\n' % robottype)
+                return trader_registry.lookup(robottype)(robottype, name, 0.00, 0)
 
 
         def shuffle_traders(ttype_char, n, traders):
@@ -1939,12 +2040,19 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
 
 
 # one session in the market
-def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dumpfile, dump_each_trade, verbose):
+# quotes and trades are checked by validator (see validation.py), which collects the violations of every
+# session it is handed; without one, the session makes its own that checks everything
+def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dumpfile, dump_each_trade, verbose,
+                   validator=None):
 
 
         # initialise the exchange
         exchange = Exchange()
 
+        if validator == None:
+                validator = validation.Validator()
+        validator.start_session(sess_id)
+
 
         # create a bunch of traders
         traders = {}
@@ -2003,16 +2111,22 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
                 # if verbose: print('Trader Quote: %s' % (order))
 
                 if order != None:
-                        if order.otype == 'Ask' and order.price < traders[tid].orders[0].price: sys.exit('Bad ask')
-                        if order.otype == 'Bid' and order.price > traders[tid].orders[0].price: sys.exit('Bad bid')
+                        # the price is put on the exchange's grid first, so the check sees the price that reaches the book
+                        exchange.quantise(order)
+                        if not validator.check_quote(time, traders[tid], order):
+                                # the quote is reported and not sent to the exchange
+                                order = None
+
+                if order != None:
                         # send order to exchange
                         traders[tid].n_quotes = 1
                         trade = exchange.process_order2(time, order, process_verbose)
                         if trade != None:
                                 # trade occurred,
                                 # so the counterparties update order lists and blotters
-                                traders[trade['party1']].bookkeep(trade, order, bookkeep_verbose, time)
-                                traders[trade['party2']].bookkeep(trade, order, bookkeep_verbose, time)
+                                for party in (trade['party1'], trade['party2']):
+                                        validator.check_trade(time, traders[party], trade['price'])
+                                        traders[party].bookkeep(trade, order, bookkeep_verbose, time)
                                 if dump_each_trade: trade_stats(sess_id, traders, tdump, time, exchange.publish_lob(time, lob_verbose))
 
                         # traders respond to whatever happened
@@ -2042,10 +2156,15 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
 
 if __name__ == "__main__":
 
+        # the ratio sweep (trader types, population size, trials) comes from a definition file,
+        # optionally followed by a shard index and shard count, e.g. python snashall2019.py sweeps/snashall2019.json 0 4
+        sweep_fname, shard_index, n_shards = sweep.sweep_args(sys.argv, 'sweeps/snashall2019.json')
+        sweep_def = sweep.load_sweep(sweep_fname)
+
         # set up parameters for the session
 
-        start_time = 0.0
-        end_time = 330.0
+        start_time = sweep_def['start_time']
+        end_time = sweep_def['end_time']
         duration = end_time - start_time
 
 
@@ -2136,22 +2255,21 @@ if __name__ == "__main__":
         # NB this has weakness of symmetric proportions on buyers/sellers -- combinatorics of varying that are quite nasty
 
 
-        n_trader_types = 4
-        equal_ratio_n = 4
-        n_trials_per_ratio = 15
-
-        n_traders = n_trader_types * equal_ratio_n
-
-        fname = '15_balances_withZIP_M1_periodic.csv'
+        fname = sweep.shard_fname(sweep_def['results'], shard_index, n_shards)
 
         tdump = open(fname, 'w')
 
-        min_n = 0
+        price_quantiser = quantiser.from_setting(sweep_def['price_quantiser'], ticksize, bse_sys_minprice, bse_sys_maxprice)
+
+        # one validator for the whole run, so the violations of every session end up in one file
+        validator = validation.Validator(sweep_def['validation'])
+        blotter_mode = sweep_def['blotter_mode']
+        blotter_window = sweep_def['blotter_window']
 
         trialnumber = 1
 
         tdump.write('%s, %s, ' % ('expid', 'time'))
-        for f in range(4):
+        for f in range(len(sweep_def['trader_types'])):
                 tdump.write('%s, %s, %s, %s, ' % ('type', 'balance', 'number of traders', 'profit per trader'))
         tdump.write('\n');
 
@@ -2168,30 +2286,19 @@ if __name__ == "__main__":
         #        trial = trial + 1
         #        trialnumber = trialnumber + 1
 
-        trdr_1_n = min_n
-        while trdr_1_n <= n_traders:
-               trdr_2_n = min_n
-               while trdr_2_n <= n_traders - trdr_1_n:
-                       trdr_3_n = min_n
-                       while trdr_3_n <= n_traders - (trdr_1_n + trdr_2_n):
-                               trdr_4_n = n_traders - (trdr_1_n + trdr_2_n + trdr_3_n)
-                               if trdr_4_n >= min_n:
-                                       buyers_spec = [('AA', trdr_1_n), ('GDX', trdr_2_n),
-                                                      ('ASAD', trdr_3_n), ('ZIP', trdr_4_n)]
-                                       sellers_spec = buyers_spec
-                                       traders_spec = {'sellers':sellers_spec, 'buyers':buyers_spec}
-                                       # print buyers_spec
-                                       trial = 1
-                                       while trial <= n_trials_per_ratio:
-                                               trial_id = 'trial%07d' % trialnumber
-                                               market_session(trial_id, start_time, end_time, traders_spec,
-                                                              order_sched, tdump, False, True)
-                                               tdump.flush()
-                                               trial = trial + 1
-                                               trialnumber = trialnumber + 1
-                               trdr_3_n += 1
-                       trdr_2_n += 1
-               trdr_1_n += 1
+        for task in sweep.select(sweep.sweep_trials(sweep_def), shard_index, n_shards):
+                buyers_spec = task['config']['spec']
+                sellers_spec = buyers_spec
+                traders_spec = {'sellers':sellers_spec, 'buyers':buyers_spec}
+                trial_id = 'trial%07d' % task['trialnumber']
+                market_session(trial_id, start_time, end_time, traders_spec,
+                               order_sched, tdump, False, True, validator)
+                tdump.flush()
+                trialnumber = task['trialnumber'] + 1
         tdump.close()
+        if len(validator.violations) > 0:
+                violations_fname = sweep.shard_fname('profit_violations.csv', shard_index, n_shards)
+                validator.write(violations_fname)
+                print('%d profit-invariant violations, written to %s' % (len(validator.violations), violations_fname))
 
         print trialnumber
@@ -0,0 +1,195 @@
+'''
+Declarative definitions of the trader-ratio sweeps.
+
+A sweep is described by a JSON file (see sweeps/) instead of nested loops baked into the
+experiment scripts:
+
+    {
+        "name":          name of the sweep, also used for the results file,
+        "trader_types":  list of robot types whose ratios are varied, e.g. ["AA", "GDX", "ZIP"],
+        "equal_ratio_n": traders per type at equal ratio (population is len(trader_types) * this),
+                         or "n_traders" to give the population size directly,
+        "min_n":         minimum number of traders of each type in a composition,
+        "noise":         {"min_prob": .., "max_prob_plus_one_step": .., "steps": ..}, or
+                         {"probabilities": [..]}; defaults to a single step with no noise,
+        "n_trials":      market sessions per composition (per noise step),
+        "start_time", "end_time": session times,
+        "schedule":      {"source": "random", "params": {...random_order_schedule arguments}},
+                         (sharded runs need "seeded" and "seed" in the params, so every shard draws
+                         the same schedule),
+                         {"source": "file", "path": file holding a written order schedule}, or
+                         {"source": "script"} when the script builds its own schedule,
+        "results":       file name for the trade_stats dump,
+        "results_format": "csv" for the trade_stats layout or "typed" for fixed per-type columns,
+        "validation":    "always", "sampled" or "off": how often the profit invariants are checked,
+        "price_quantiser": null to take quote prices as quoted, or {"tick": .., "bid_rounding": ..,
+                         "ask_rounding": ..} to round them on the exchange (see quantiser.py),
+        "exact_noise":   true to weight every distinct noisy spec by its probability instead of drawing
+                         one (borsim); its sessions are cached and shared across noise steps, so the
+                         summary file lists them under the noise probability 'shared',
+        "gdx_memory":    "full", "window" or "time": which accepted bids and asks GDX traders remember,
+                         the last "gdx_memory_window" of each or those of the last "gdx_memory_horizon"
+                         seconds (borsim),
+        "blotter_mode":  "full", "window" or "aggregate": what each trader keeps of its own trades, the
+                         last "blotter_window" records or only their count and total profit (borsim and
+                         snashall2019),
+        "random_blocks": true to draw the strategies' random numbers from per-session numpy blocks of
+                         "random_block_size" (borsim; ignored without numpy),
+        "schedule_wakeups": true to leave sleeping traders out of the choice of who quotes next until
+                         their wakeup time (borsim)
+    }
+
+Everything below is generated lazily, so a sweep can be streamed to workers, sharded or
+only partly executed without building the whole list of configurations in memory.
+'''
+import ast
+import itertools
+import json
+import sys
+
+
+sweep_defaults = {'min_n': 1,
+                  'noise': {'probabilities': [0]},
+                  'n_trials': 1,
+                  'start_time': 0.0,
+                  'end_time': 330.0,
+                  'schedule': {'source': 'script'},
+                  'results_format': 'csv',
+                  'validation': 'always',
+                  'price_quantiser': None,
+                  'exact_noise': False,
+                  'gdx_memory': 'full',
+                  'gdx_memory_window': 100,
+                  'gdx_memory_horizon': 120.0,
+                  'blotter_mode': 'full',
+                  'blotter_window': 100,
+                  'random_blocks': False,
+                  'random_block_size': 4096,
+                  'schedule_wakeups': False}
+
+# the values the policy settings may take, with what an unknown value is called in the error
+setting_choices = {'gdx_memory': ('GDX memory policy', ('full', 'window', 'time')),
+                   'blotter_mode': ('blotter mode', ('full', 'window', 'aggregate')),
+                   'random_blocks': ('random_blocks setting', (False, True)),
+                   'schedule_wakeups': ('schedule_wakeups setting', (False, True))}
+
+
+# read a sweep definition file and fill in the defaults
+def load_sweep(fname):
+    sweep_file = open(fname, 'r')
+    sweep = json.load(sweep_file)
+    sweep_file.close()
+    for key in sweep_defaults:
+        if key not in sweep:
+            sweep[key] = sweep_defaults[key]
+    if 'trader_types' not in sweep or len(sweep['trader_types']) < 1:
+        sys.exit('FATAL: sweep %s has no trader_types' % fname)
+    if 'n_traders' not in sweep:
+        if 'equal_ratio_n' not in sweep:
+            sys.exit('FATAL: sweep %s needs n_traders or equal_ratio_n' % fname)
+        sweep['n_traders'] = len(sweep['trader_types']) * sweep['equal_ratio_n']
+    if 'name' not in sweep:
+        sweep['name'] = fname
+    # json gives unicode strings under Python 2; trader types end up in trader ids and result files
+    sweep['trader_types'] = [str(ttype) for ttype in sweep['trader_types']]
+    if 'results' in sweep:
+        sweep['results'] = str(sweep['results'])
+    sweep['results_format'] = str(sweep['results_format'])
+    sweep['validation'] = str(sweep['validation'])
+    # a bad policy name ends the run here, not when the first trader that uses it is built
+    for key in setting_choices:
+        (setting_name, choices) = setting_choices[key]
+        if sweep[key] not in choices:
+            sys.exit('FATAL: unknown %s %s in sweep %s' % (setting_name, sweep[key], fname))
+        sweep[key] = choices[choices.index(sweep[key])]  # the choice itself, not json's unicode copy of it
+    return sweep
+
+
+# the noise probabilities of the sweep, in order
+# the stepped form is computed exactly like the original loop did, so integer settings keep their old meaning
+def noise_probabilities(sweep):
+    noise = sweep['noise']
+    if 'probabilities' in noise:
+        for noise_probability in noise['probabilities']:
+            yield noise_probability
+    else:
+        min_prob = noise['min_prob']
+        for noise_step in range(0, noise['steps']):
+            yield min_prob + (((noise['max_prob_plus_one_step'] - min_prob) / noise['steps']) * noise_step)
+
+
+# lazily yields every way of splitting n_total traders over n_parts types with at least min_n of each,
+# in the order the old nested while-loops visited them (first type slowest)
+def simplex_compositions(n_total, n_parts, min_n):
+    if n_parts == 1:
+        if n_total >= min_n:
+            yield (n_total,)
+        return
+    n = min_n
+    while n <= n_total:
+        for rest in simplex_compositions(n_total - n, n_parts - 1, min_n):
+            yield (n,) + rest
+        n += 1
+
+
+# yields one configuration per (noise probability, composition), noise probability slowest
+# each configuration carries its position in the sweep so that shards can be told apart
+def sweep_configurations(sweep):
+    index = 0
+    for noise_step, noise_probability in enumerate(noise_probabilities(sweep)):
+        for ratio in simplex_compositions(sweep['n_traders'], len(sweep['trader_types']), sweep['min_n']):
+            yield {'index': index,
+                   'noise_step': noise_step,
+                   'noise_probability': noise_probability,
+                   'ratio': ratio,
+                   'spec': list(zip(sweep['trader_types'], ratio))}
+            index += 1
+
+
+# yields one task per market session: a configuration, the trial within it, and a trial number
+# that only depends on the task's place in the sweep (so sharded runs number trials consistently)
+def sweep_trials(sweep, configurations=None):
+    if configurations is None:
+        configurations = sweep_configurations(sweep)
+    for config in configurations:
+        for trial in range(1, sweep['n_trials'] + 1):
+            yield {'config': config,
+                   'trial': trial,
+                   'trialnumber': config['index'] * sweep['n_trials'] + trial}
+
+
+# take part of a stream of configurations or tasks: every n_shards'th item starting at shard_index,
+# optionally limited to items start..stop (before sharding) for partial runs
+def select(tasks, shard_index=0, n_shards=1, start=0, stop=None):
+    return itertools.islice(itertools.islice(tasks, start, stop), shard_index, None, n_shards)
+
+
+# parse "<sweep file> [shard_index n_shards]" from a command line
+def sweep_args(argv, default_fname):
+    fname = default_fname
+    shard_index = 0
+    n_shards = 1
+    if len(argv) > 1:
+        fname = argv[1]
+    if len(argv) > 3:
+        shard_index = int(argv[2])
+        n_shards = int(argv[3])
+    return fname, shard_index, n_shards
+
+
+# results file name for one shard of a sweep
+def shard_fname(fname, shard_index, n_shards):
+    if n_shards == 1:
+        return fname
+    dot = fname.rfind('.')
+    if dot < 0:
+        dot = len(fname)
+    return '%s_shard%03d_of_%03d%s' % (fname[:dot], shard_index, n_shards, fname[dot:])
+
+
+# an order schedule written out by random_order_schedule() (order_schedule_description.txt)
+def load_schedule(fname):
+    schedule_file = open(fname, 'r')
+    order_sched = ast.literal_eval(schedule_file.read().strip())
+    schedule_file.close()
+    return order_sched
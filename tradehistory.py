@@ -0,0 +1,75 @@
+'''
+Time-indexed history of the trades on an exchange, shared by all traders.
+
+The exchange records every trade once and publishes the history with the LOB (lob['trades']), so
+strategies can look up recent prices instead of each keeping its own copy of the trades they
+reconstructed from respond() calls.
+
+Trades are kept in time order together with running (prefix) sums of price, price * quantity and
+quantity, so every query is O(1) or O(log n) however long the session has run:
+    last(n)         -- prices of the last n trades
+    since(t)        -- prices of the trades at or after time t
+    mean(), vwap()  -- mean and volume-weighted mean price over the last n trades or since time t
+'''
+import bisect
+
+
+class TradeHistory:
+
+    def __init__(self):
+        self.times = []
+        self.prices = []
+        # sums over the first i trades are at index i, so the sum over trades i..j-1 is sums[j] - sums[i]
+        self.sum_price = [0]
+        self.sum_value = [0]  # price * quantity
+        self.sum_qty = [0]
+
+    def __len__(self):
+        return len(self.prices)
+
+    # trades come in time order, as the exchange processes them
+    def record(self, time, price, qty):
+        self.times.append(time)
+        self.prices.append(price)
+        self.sum_price.append(self.sum_price[-1] + price)
+        self.sum_value.append(self.sum_value[-1] + price * qty)
+        self.sum_qty.append(self.sum_qty[-1] + qty)
+
+    # index of the first trade at or after time t
+    def index_at(self, t):
+        return bisect.bisect_left(self.times, t)
+
+    # index range of the last n trades, or of the trades since time t, or of all trades
+    def span(self, n=None, since=None):
+        start = 0
+        if n != None:
+            start = max(len(self.prices) - n, 0)
+        if since != None:
+            start = max(start, self.index_at(since))
+        return start, len(self.prices)
+
+    def last(self, n):
+        return self.prices[self.span(n=n)[0]:]
+
+    def since(self, t):
+        return self.prices[self.index_at(t):]
+
+    def last_price(self):
+        if len(self.prices) == 0:
+            return None
+        return self.prices[-1]
+
+    # mean trade price over the last n trades or since time t (None if there are no such trades)
+    def mean(self, n=None, since=None):
+        start, end = self.span(n, since)
+        if end == start:
+            return None
+        return float(self.sum_price[end] - self.sum_price[start]) / (end - start)
+
+    # volume-weighted mean trade price over the last n trades or since time t
+    def vwap(self, n=None, since=None):
+        start, end = self.span(n, since)
+        qty = self.sum_qty[end] - self.sum_qty[start]
+        if qty == 0:
+            return None
+        return float(self.sum_value[end] - self.sum_value[start]) / qty
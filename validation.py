@@ -0,0 +1,83 @@
+'''
+Checks of the profit invariants of the market sessions: no quote beyond its trader's limit price,
+and no trade at a loss.
+
+An experiment script makes one Validator for its run, from the sweep's "validation" setting, and
+hands it to every market_session(). The session checks each quote before it goes to the exchange
+and each trade before the traders book it. A failed check does not end the run: it is added to the
+validator's violations, which the script writes out at the end (unless the validator is fatal,
+which exits as the old checks did). The modes are
+    'always'   -- check every quote and trade (debugging and test runs)
+    'sampled'  -- check one in every sample_every
+    'off'      -- check nothing (production sweeps)
+'''
+import sys
+
+
+modes = ('always', 'sampled', 'off')
+
+
+class Validator:
+
+    def __init__(self, mode='always', sample_every=100, fatal=False):
+        if mode not in modes:
+            sys.exit('FATAL: unknown validation mode %s' % mode)
+        self.mode = mode
+        self.sample_every = sample_every
+        self.fatal = fatal
+        self.countdown = 1  # checks to go until the next sampled one
+        self.n_checked = 0
+        self.sess_id = None  # the session the checks belong to, set by market_session()
+        self.violations = []  # one dict per failed check: session, time, tid, check, and the prices involved
+
+    def start_session(self, sess_id):
+        self.sess_id = sess_id
+
+    # whether to make the next check; sampled checks are counted off rather than drawn,
+    # so they leave the market's random numbers alone
+    def wants_check(self):
+        if self.mode == 'always':
+            self.n_checked += 1
+            return True
+        elif self.mode == 'off':
+            return False
+        self.countdown -= 1
+        if self.countdown > 0:
+            return False
+        self.countdown = self.sample_every
+        self.n_checked += 1
+        return True
+
+    # a quote must not be worse for its trader than the limit price of the trader's customer order;
+    # returns False for a quote that failed the check, which is then not sent to the exchange
+    def check_quote(self, time, trader, order):
+        if not self.wants_check():
+            return True
+        limit = trader.orders[0].price
+        if (order.otype == 'Ask' and order.price < limit) or (order.otype == 'Bid' and order.price > limit):
+            self.report('%s beyond limit' % order.otype.lower(), time, trader.tid, order.price, limit)
+            return False
+        return True
+
+    # a trade must not lose its trader money; checked before bookkeep() deletes the customer order
+    def check_trade(self, time, trader, price):
+        if not self.wants_check():
+            return
+        limit = trader.orders[0].price
+        if (trader.orders[0].otype == 'Bid' and price > limit) or (trader.orders[0].otype == 'Ask' and price < limit):
+            self.report('trade at a loss', time, trader.tid, price, limit)
+
+    def report(self, check, time, tid, price, limit):
+        if self.fatal:
+            sys.exit('FATAL: %s: %s at t=%.2f, price %s, limit %s' % (check, tid, time, price, limit))
+        self.violations.append({'session': self.sess_id, 'time': time, 'tid': tid, 'check': check,
+                                'price': price, 'limit': limit})
+
+    # write the violations so far to a CSV file
+    def write(self, fname):
+        vfile = open(fname, 'w')
+        vfile.write('%s, %s, %s, %s, %s, %s\n' % ('session', 'time', 'tid', 'check', 'price', 'limit'))
+        for v in self.violations:
+            vfile.write('%s, %f, %s, %s, %s, %s\n' % (v['session'], v['time'], v['tid'], v['check'],
+                                                      v['price'], v['limit']))
+        vfile.close()